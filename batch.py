@@ -0,0 +1,517 @@
+# Runs N copies of a machine in lockstep with NumPy.
+#
+# The machines are stored as a structure of arrays, one row per lane:
+# registers (N x 16), pc (N), memory (N x 4096) and display (N x 32 rows of
+# uint64). A step fetches one opcode for every lane, groups the lanes by op
+# and applies each op to its whole group at once, so the Python overhead of
+# a step is paid per distinct op instead of per machine.
+#
+# The instruction semantics are those of the exec_* handlers in chip8.py,
+# for the quirks the machines were made with, which all lanes share.
+# Where a handler would fail an assertion or index out of memory, the lane
+# stops instead: it is marked dead with its error and cycle count, and the
+# other lanes keep running.
+import numpy as np
+from chip8 import *
+
+# Why a lane stopped, see Batch.error
+( LaneOk
+, LaneUnknownInstruction
+, LaneStackOverflow
+, LaneStackUnderflow
+, LaneBadFont
+, LaneBadAddress
+) = range(6)
+
+LANE_ERRORS = (
+    "Ok",
+    "Unknown instruction",
+    "Stack overflow",
+    "Stack underflow",
+    "Font character out of range",
+    "Address out of memory",
+)
+
+_OP_TABLE = None
+
+def op_table(): # opcode -> op constant, -1 where decode_opcode fails
+    global _OP_TABLE
+    if _OP_TABLE is None:
+        table = np.full(1 << 16, -1, dtype=np.int8)
+        for opcode in range(1 << 16):
+            try:
+                table[opcode] = decode_opcode(opcode)[0]
+            except AssertionError:
+                pass
+        _OP_TABLE = table
+    return _OP_TABLE
+
+class Batch:
+    __slots__ = (
+        'pc',
+        'index',
+        'regs',
+        'memory',
+        'display',
+        'stack',
+        'sp',
+        'delay_timer',
+        'sound_timer',
+        'keys',
+        'cycles',
+        'alive',
+        'error',
+        'rng',
+        'quirks',
+        'handlers', # batch_handlers(quirks)
+    )
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.pc)
+
+def batch_from_states(states):
+    quirks = states[0].quirks
+    assert all(s.quirks == quirks for s in states), "Lanes with different quirks"
+    stack = np.zeros((len(states), 16), dtype=np.int32)
+    for (lane, state) in enumerate(states):
+        values = stack_to_list(state.stack)
+        stack[lane, :len(values)] = values
+    return Batch(
+        pc          = np.array([s.pc for s in states], dtype=np.int32),
+        index       = np.array([s.index for s in states], dtype=np.int32),
+        regs        = np.array([bytearray(s.regs) for s in states], dtype=np.uint8),
+        memory      = np.array([bytearray(bytes(s.memory)) for s in states], dtype=np.uint8),
+        display     = np.array([s.display for s in states], dtype=np.uint64),
+        stack       = stack,
+        sp          = np.array([stack_depth(s.stack) for s in states], dtype=np.int32),
+        delay_timer = np.array([s.delay_timer for s in states], dtype=np.int32),
+        sound_timer = np.array([s.sound_timer for s in states], dtype=np.int32),
+        keys        = np.array([s.keys for s in states], dtype=np.int32),
+        cycles      = np.array([s.cycles for s in states], dtype=np.int64),
+        alive       = np.ones(len(states), dtype=bool),
+        error       = np.zeros(len(states), dtype=np.int8),
+        rng         = np.array([s.rng for s in states], dtype=np.uint32),
+        quirks      = quirks,
+        handlers    = batch_handlers(quirks),
+    )
+
+# With a seed, lane N gets its own generator seeded with seed + N
+def batch_from_state(state, n, seed=None):
+    batch = batch_from_states([state] * n)
+    if seed is not None:
+        batch.rng[:] = [seed_rng(seed + lane) for lane in range(n)]
+    return batch
+
+def lane_to_state(batch, lane):
+    state = default_state(quirks=batch.quirks)
+    state.pc          = int(batch.pc[lane])
+    state.index       = int(batch.index[lane])
+    state.regs        = array('B', batch.regs[lane].tobytes())
+    state.memory      = memory_from_bytes(batch.memory[lane].tobytes())
+    state.display     = tuple(int(row) for row in batch.display[lane])
+    state.delay_timer = int(batch.delay_timer[lane])
+    state.sound_timer = int(batch.sound_timer[lane])
+    state.keys        = int(batch.keys[lane])
+    state.cycles      = int(batch.cycles[lane])
+    state.rng         = int(batch.rng[lane])
+    stack = empty_stack()
+    for x in batch.stack[lane, :batch.sp[lane]]:
+        stack = safe_push(stack, int(x))
+    state.stack = stack
+    return state
+
+def kill(batch, lanes, error):
+    batch.alive[lanes] = False
+    batch.error[lanes] = error
+
+# Every exec_* below gets the batch, the lanes running that op and the
+# opcode fields of those lanes, and updates the lanes in place.
+class Fields:
+    __slots__ = ('x', 'y', 'n', 'nn', 'nnn')
+
+def vx(batch, m, f): # as wide ints, so arithmetic does not wrap early
+    return batch.regs[m, f.x].astype(np.int32)
+
+def vy(batch, m, f):
+    return batch.regs[m, f.y].astype(np.int32)
+
+def set_vx(batch, m, f, values):
+    batch.regs[m, f.x] = (values & 0xFF).astype(np.uint8)
+
+def skip_where(batch, m, cond):
+    batch.pc[m[cond]] += 2
+
+def exec_nop(batch, m, f):
+    pass
+
+def exec_clear_screen(batch, m, f):
+    batch.display[m] = 0
+
+def exec_return(batch, m, f):
+    empty = batch.sp[m] == 0
+    kill(batch, m[empty], LaneStackUnderflow)
+    m = m[~empty]
+    batch.sp[m] -= 1
+    batch.pc[m] = batch.stack[m, batch.sp[m]]
+
+def exec_jump(batch, m, f):
+    batch.pc[m] = f.nnn
+
+def exec_call(batch, m, f):
+    full = batch.sp[m] == 16
+    kill(batch, m[full], LaneStackOverflow)
+    (m, nnn) = (m[~full], f.nnn[~full])
+    batch.stack[m, batch.sp[m]] = batch.pc[m]
+    batch.sp[m] += 1
+    batch.pc[m] = nnn
+
+def exec_skip_cond_eq(batch, m, f):
+    skip_where(batch, m, vx(batch, m, f) == f.nn)
+
+def exec_skip_cond_neq(batch, m, f):
+    skip_where(batch, m, vx(batch, m, f) != f.nn)
+
+def exec_skip_cond_reg_eq(batch, m, f):
+    skip_where(batch, m, vx(batch, m, f) == vy(batch, m, f))
+
+def exec_skip_cond_reg_neq(batch, m, f):
+    skip_where(batch, m, vx(batch, m, f) != vy(batch, m, f))
+
+def exec_set(batch, m, f):
+    set_vx(batch, m, f, f.nn)
+
+def exec_add(batch, m, f):
+    set_vx(batch, m, f, vx(batch, m, f) + f.nn)
+
+def exec_set_r(batch, m, f):
+    set_vx(batch, m, f, vy(batch, m, f))
+
+def exec_bin_or(batch, m, f):
+    set_vx(batch, m, f, vx(batch, m, f) | vy(batch, m, f))
+
+def exec_bin_and(batch, m, f):
+    set_vx(batch, m, f, vx(batch, m, f) & vy(batch, m, f))
+
+def exec_bin_xor(batch, m, f):
+    set_vx(batch, m, f, vx(batch, m, f) ^ vy(batch, m, f))
+
+def exec_add_r(batch, m, f):
+    set_vx(batch, m, f, vx(batch, m, f) + vy(batch, m, f))
+
+def exec_sub12(batch, m, f):
+    set_vx(batch, m, f, vx(batch, m, f) - vy(batch, m, f))
+
+def exec_sub21(batch, m, f):
+    set_vx(batch, m, f, vy(batch, m, f) - vx(batch, m, f))
+
+def exec_shift_l(batch, m, f):
+    old = vx(batch, m, f)
+    set_vx(batch, m, f, old << 1)
+    batch.regs[m, 0xF] = ((old & (1 << 15)) & 0xFF).astype(np.uint8)
+
+def exec_shift_r(batch, m, f):
+    old = vx(batch, m, f)
+    set_vx(batch, m, f, old >> 1)
+    batch.regs[m, 0xF] = (old & 1).astype(np.uint8)
+
+def exec_set_index(batch, m, f):
+    batch.index[m] = f.nnn
+
+def exec_jump_offset(batch, m, f):
+    batch.pc[m] = f.nnn + batch.regs[m, 0x0].astype(np.int32)
+
+def exec_random(batch, m, f): # next_random, on uint32 so shifts wrap by themselves
+    rng = batch.rng[m]
+    rng ^= rng << np.uint32(13)
+    rng ^= rng >> np.uint32(17)
+    rng ^= rng << np.uint32(5)
+    batch.rng[m] = rng
+    set_vx(batch, m, f, (rng >> np.uint32(24)).astype(np.int32) & f.nn)
+
+def exec_display(batch, m, f):
+    x = (vx(batch, m, f) & 63).astype(np.uint64)
+    y = vy(batch, m, f) & 31
+    index = batch.index[m]
+    collided = np.zeros(len(m), dtype=bool)
+    for i in range(15):
+        # Same clipping as the handler: rows below the screen are not drawn
+        # and their sprite bytes are not read
+        rows = (i < f.n) & (y + i < 32)
+        if not rows.any():
+            break
+        bad = rows & (index + i >= len(batch.memory[0]))
+        if bad.any():
+            kill(batch, m[bad], LaneBadAddress)
+            rows &= ~bad
+        lanes = m[rows]
+        row = y[rows] + i
+        sprite = (batch.memory[lanes, index[rows] + i].astype(np.uint64) << np.uint64(56)) >> x[rows]
+        old = batch.display[lanes, row]
+        collided[rows] |= (old & sprite) != 0
+        batch.display[lanes, row] = old ^ sprite
+    ok = batch.alive[m]
+    batch.regs[m[ok], 0xF] = collided[ok].astype(np.uint8)
+
+def pressed(batch, m, f):
+    key = vx(batch, m, f)
+    return (key < 16) & (((batch.keys[m] >> np.minimum(key, 15)) & 1) == 1)
+
+def exec_skip_if_pressed(batch, m, f):
+    skip_where(batch, m, pressed(batch, m, f))
+
+def exec_skip_if_not_pressed(batch, m, f):
+    skip_where(batch, m, ~pressed(batch, m, f))
+
+def exec_reg_from_delay_timer(batch, m, f):
+    set_vx(batch, m, f, batch.delay_timer[m])
+
+def exec_delay_timer_from_reg(batch, m, f):
+    batch.delay_timer[m] = vx(batch, m, f)
+
+def exec_sound_timer_from_reg(batch, m, f):
+    batch.sound_timer[m] = vx(batch, m, f)
+
+def exec_add_to_index(batch, m, f):
+    batch.index[m] += vx(batch, m, f)
+
+def exec_get_pressed_value(batch, m, f):
+    keys = batch.keys[m]
+    waiting = keys == 0
+    batch.pc[m[waiting]] -= 2
+    (m, keys, x) = (m[~waiting], keys[~waiting], f.x[~waiting])
+    lowest = keys & -keys
+    batch.regs[m, x] = (np.log2(lowest).astype(np.int32)).astype(np.uint8)
+
+def exec_font_character(batch, m, f):
+    value = vx(batch, m, f)
+    bad = value >= 16
+    kill(batch, m[bad], LaneBadFont)
+    batch.index[m[~bad]] = value[~bad] * 5 + 0x50
+
+def lanes_in_memory(batch, m, f, end):
+    bad = batch.index[m] + end > len(batch.memory[0])
+    kill(batch, m[bad], LaneBadAddress)
+    return (m[~bad], f.x[~bad])
+
+def exec_hex_to_decimal_to_index(batch, m, f):
+    value = vx(batch, m, f)
+    index = batch.index[m]
+    bad = index + 3 > len(batch.memory[0])
+    kill(batch, m[bad], LaneBadAddress)
+    (m, value, index) = (m[~bad], value[~bad], index[~bad])
+    batch.memory[m, index + 0] = value // 100
+    batch.memory[m, index + 1] = (value // 10) % 10
+    batch.memory[m, index + 2] = value % 10
+
+def exec_store_regs(batch, m, f):
+    bad = batch.index[m] + f.x + 1 > len(batch.memory[0])
+    kill(batch, m[bad], LaneBadAddress)
+    (m, end) = (m[~bad], f.x[~bad])
+    for i in range(16):
+        lanes = m[i <= end]
+        if len(lanes) == 0:
+            break
+        batch.memory[lanes, batch.index[lanes] + i] = batch.regs[lanes, i]
+
+def exec_load_regs(batch, m, f):
+    bad = batch.index[m] + f.x + 1 > len(batch.memory[0])
+    kill(batch, m[bad], LaneBadAddress)
+    (m, end) = (m[~bad], f.x[~bad])
+    for i in range(16):
+        lanes = m[i <= end]
+        if len(lanes) == 0:
+            break
+        batch.regs[lanes, i] = batch.memory[lanes, batch.index[lanes] + i]
+
+# The handlers of the quirks that differ from chippy's, like the ones in chip8.py
+
+def exec_add_r_carry(batch, m, f):
+    total = vx(batch, m, f) + vy(batch, m, f)
+    set_vx(batch, m, f, total)
+    batch.regs[m, 0xF] = (total >> 8).astype(np.uint8)
+
+def exec_sub12_borrow(batch, m, f):
+    (a, b) = (vx(batch, m, f), vy(batch, m, f))
+    set_vx(batch, m, f, a - b)
+    batch.regs[m, 0xF] = (a >= b).astype(np.uint8)
+
+def exec_sub21_borrow(batch, m, f):
+    (a, b) = (vx(batch, m, f), vy(batch, m, f))
+    set_vx(batch, m, f, b - a)
+    batch.regs[m, 0xF] = (b >= a).astype(np.uint8)
+
+def make_shift(left, read, carry): # read is vx or vy
+    if left:
+        def exec_shift(batch, m, f):
+            old = read(batch, m, f)
+            set_vx(batch, m, f, old << 1)
+            batch.regs[m, 0xF] = ((old >> 7) & carry).astype(np.uint8)
+    else:
+        def exec_shift(batch, m, f):
+            old = read(batch, m, f)
+            set_vx(batch, m, f, old >> 1)
+            batch.regs[m, 0xF] = (old & 1).astype(np.uint8)
+    return exec_shift
+
+def with_vf_reset(handler):
+    def exec_and_reset_vf(batch, m, f):
+        handler(batch, m, f)
+        batch.regs[m, 0xF] = 0
+    return exec_and_reset_vf
+
+def with_index_increment(handler, extra):
+    def exec_and_increment_index(batch, m, f):
+        handler(batch, m, f)
+        ok = batch.alive[m]
+        batch.index[m[ok]] += f.x[ok] + extra
+    return exec_and_increment_index
+
+def exec_jump_offset_vx(batch, m, f):
+    batch.pc[m] = f.nnn + batch.regs[m, f.x].astype(np.int32)
+
+def exec_display_wrap(batch, m, f):
+    x = (vx(batch, m, f) & 63).astype(np.uint64)
+    y = vy(batch, m, f) & 31
+    index = batch.index[m]
+    collided = np.zeros(len(m), dtype=bool)
+    for i in range(15):
+        rows = i < f.n
+        if not rows.any():
+            break
+        bad = rows & (index + i >= len(batch.memory[0]))
+        if bad.any():
+            kill(batch, m[bad], LaneBadAddress)
+            rows &= ~bad
+        lanes = m[rows]
+        row = (y[rows] + i) & 31
+        sprite = batch.memory[lanes, index[rows] + i].astype(np.uint64) << np.uint64(56)
+        # Rotated right by x; in two steps so that x = 0 never shifts by 64
+        sprite = (sprite >> x[rows]) | ((sprite << (np.uint64(63) - x[rows])) << np.uint64(1))
+        old = batch.display[lanes, row]
+        collided[rows] |= (old & sprite) != 0
+        batch.display[lanes, row] = old ^ sprite
+    ok = batch.alive[m]
+    batch.regs[m[ok], 0xF] = collided[ok].astype(np.uint8)
+
+# Indexed by the op constants, like chip8.HANDLERS
+BATCH_HANDLERS = (
+    exec_nop,
+    exec_clear_screen,
+    exec_return,
+    exec_jump,
+    exec_call,
+    exec_skip_cond_eq,
+    exec_skip_cond_neq,
+    exec_skip_cond_reg_eq,
+    exec_skip_cond_reg_neq,
+    exec_set,
+    exec_add,
+    exec_set_r,
+    exec_bin_or,
+    exec_bin_and,
+    exec_bin_xor,
+    exec_add_r,
+    exec_sub12,
+    exec_sub21,
+    exec_shift_l,
+    exec_shift_r,
+    exec_set_index,
+    exec_jump_offset,
+    exec_random,
+    exec_display,
+    exec_skip_if_pressed,
+    exec_skip_if_not_pressed,
+    exec_reg_from_delay_timer,
+    exec_delay_timer_from_reg,
+    exec_sound_timer_from_reg,
+    exec_add_to_index,
+    exec_get_pressed_value,
+    exec_font_character,
+    exec_hex_to_decimal_to_index,
+    exec_store_regs,
+    exec_load_regs,
+)
+
+assert len(BATCH_HANDLERS) == len(HANDLERS)
+
+BATCH_QUIRK_HANDLERS = {DEFAULT_QUIRKS: BATCH_HANDLERS}
+
+def batch_handlers(quirks): # quirk_handlers() for batches
+    handlers = BATCH_QUIRK_HANDLERS.get(quirks)
+    if handlers is not None:
+        return handlers
+    table = list(BATCH_HANDLERS)
+    if quirks.vf_flags:
+        table[AddR]  = exec_add_r_carry
+        table[Sub12] = exec_sub12_borrow
+        table[Sub21] = exec_sub21_borrow
+    if quirks.logic_vf_reset:
+        for op in (BinOr, BinAnd, BinXor):
+            table[op] = with_vf_reset(table[op])
+    if (quirks.swap_shifts, quirks.vf_flags, quirks.shift_vy) != (True, False, False):
+        (read, carry) = (vy if quirks.shift_vy else vx, int(quirks.vf_flags))
+        table[ShiftL] = make_shift(quirks.swap_shifts, read, carry)
+        table[ShiftR] = make_shift(not quirks.swap_shifts, read, carry)
+    if quirks.index_increment != 'none':
+        extra = int(quirks.index_increment == 'x+1')
+        table[StoreRegs] = with_index_increment(exec_store_regs, extra)
+        table[LoadRegs]  = with_index_increment(exec_load_regs, extra)
+    if quirks.jump_vx:
+        table[JumpOffset] = exec_jump_offset_vx
+    if quirks.sprite_wrap:
+        table[Display] = exec_display_wrap
+    handlers = tuple(table)
+    BATCH_QUIRK_HANDLERS[quirks] = handlers
+    return handlers
+
+def step_batch(batch):
+    lanes = np.flatnonzero(batch.alive)
+    pc = batch.pc[lanes]
+    bad = pc + 1 >= len(batch.memory[0])
+    if bad.any():
+        kill(batch, lanes[bad], LaneBadAddress)
+        (lanes, pc) = (lanes[~bad], pc[~bad])
+
+    opcode = batch.memory[lanes, pc].astype(np.int32) << 8 | batch.memory[lanes, pc + 1]
+    ops = op_table()[opcode]
+    unknown = ops < 0
+    if unknown.any():
+        kill(batch, lanes[unknown], LaneUnknownInstruction)
+        (lanes, opcode, ops) = (lanes[~unknown], opcode[~unknown], ops[~unknown])
+
+    batch.pc[lanes] += 2
+    batch.cycles[lanes] += 1
+
+    for op in np.unique(ops):
+        group = ops == op
+        f = Fields()
+        code  = opcode[group]
+        f.x   = (code >> 8) & 15
+        f.y   = (code >> 4) & 15
+        f.n   = code & 15
+        f.nn  = code & 0xFF
+        f.nnn = code & 0xFFF
+        batch.handlers[op](batch, lanes[group], f)
+    return batch
+
+def tick_batch_timers(batch):
+    alive = batch.alive
+    batch.delay_timer[alive] = np.maximum(batch.delay_timer[alive] - 1, 0)
+    batch.sound_timer[alive] = np.maximum(batch.sound_timer[alive] - 1, 0)
+    return batch
+
+def run_batch_frame(batch, instructions_per_frame):
+    for _ in range(instructions_per_frame):
+        step_batch(batch)
+    return tick_batch_timers(batch)
+
+def run_batch(batch, instructions_per_frame, frames):
+    for _ in range(frames):
+        if not batch.alive.any():
+            break
+        run_batch_frame(batch, instructions_per_frame)
+    return batch
@@ -0,0 +1,257 @@
+import io
+import os
+import sys
+import json
+import time
+import struct
+import random
+import platform
+import statistics
+import argparse
+import contextlib
+from chip8 import *
+from main import ENGINES
+
+# Every cost below is in nanoseconds, so lower is always better and every
+# result is compared against the baseline the same way
+
+def rom(*opcodes):
+    return b''.join([struct.pack('>H', opcode) for opcode in opcodes])
+
+# Small endless loops, each leaning on one part of the machine
+SYNTHETIC_ROMS = {
+    'alu': rom(
+        0x6001,         # 200: V0 = 1
+        0x7101,         # 202: V1 += 1
+        0x8214,         # 204: V2 += V1
+        0x8312,         # 206: V3 &= V1
+        0x8423,         # 208: V4 ^= V2
+        0x8505,         # 20A: V5 -= V0
+        0x4100,         # 20C: skip if V1 != 0
+        0x6000,         # 20E: V0 = 0
+        0x1202,         # 210: jump 202
+    ),
+    'draw': rom(
+        0x6000,         # 200: V0 = 0, x
+        0x6100,         # 202: V1 = 0, y
+        0x6200,         # 204: V2 = 0, digit
+        0xF229,         # 206: I = font V2
+        0xD015,         # 208: draw
+        0x7008,         # 20A: x += 8
+        0x7201,         # 20C: digit += 1
+        0x4210,         # 20E: skip if digit != 16
+        0x6200,         # 210: digit = 0
+        0x1206,         # 212: jump 206
+    ),
+    'calls': rom(
+        0x2206,         # 200: call 206
+        0x7001,         # 202: V0 += 1
+        0x1200,         # 204: jump 200
+        0x7101,         # 206: V1 += 1
+        0x00EE,         # 208: return
+    ),
+    'memory': rom(
+        0xA300,         # 200: I = 300
+        0xF355,         # 202: store V0..V3
+        0xF365,         # 204: load V0..V3
+        0xF033,         # 206: BCD of V0
+        0x7001,         # 208: V0 += 1
+        0x1202,         # 20A: jump 202
+    ),
+    'mixed': rom(
+        0xA050,         # 200: I = font 0
+        0x220A,         # 202: call 20A
+        0xD015,         # 204: draw
+        0x7004,         # 206: V0 += 4
+        0x1202,         # 208: jump 202
+        0x8104,         # 20A: V1 += V0
+        0x8212,         # 20C: V2 &= V1
+        0x4000,         # 20E: skip if V0 != 0
+        0x00E0,         # 210: clear screen
+        0x00EE,         # 212: return
+    ),
+}
+
+# One opcode for every op constant, run against op_state()
+OP_OPCODES = (
+    0x0000, 0x00E0, 0x00EE, 0x1200, 0x2200, 0x3000, 0x4000, 0x5010, 0x9010,
+    0x6012, 0x7012, 0x8230, 0x8231, 0x8232, 0x8233, 0x8234, 0x8235, 0x8236,
+    0x8237, 0x823E, 0xA300, 0xB200, 0xC2FF, 0xD015, 0xE19E, 0xE1A1, 0xF207,
+    0xF215, 0xF218, 0xF21E, 0xF20A, 0xF129, 0xF233, 0xFF55, 0xFF65,
+)
+
+assert sorted(decode_opcode(opcode)[0] for opcode in OP_OPCODES) == list(range(len(OP_NAMES)))
+
+def op_state():
+    state = default_state()
+    state.pc = 0x200
+    state.index = 0x50
+    state.stack = safe_push(empty_stack(), 0x200) # one entry, so Return has something to pop
+    state.keys = 1
+    for reg in range(16):
+        state = set_reg(state, reg, reg * 3)
+    return set_reg(state, 1, 5) # a valid digit for FontCharacter
+
+# The median rather than the fastest run, so one lucky run does not set a
+# number that every later run is compared against
+def median_ns(fn, repeats):
+    return statistics.median(fn() for _ in range(repeats))
+
+# Every handler changes the state it is given, so the loop puts back
+# everything an op can change before each run. The same loop without the
+# handler is timed too and subtracted.
+def exec_loop_ns(instruction, iterations):
+    state = op_state()
+    (pc, index, stack, regs) = (state.pc, state.index, state.stack, state.regs[:])
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        state.pc = pc
+        state.index = index
+        state.stack = stack
+        state.regs[:] = regs
+        if instruction is not None:
+            exec_instruction(state, instruction)
+    return time.perf_counter_ns() - start
+
+def bench_ops(iterations, repeats):
+    results = {}
+    overhead = median_ns(lambda: exec_loop_ns(None, iterations), repeats)
+    for opcode in OP_OPCODES:
+        instruction = decode_opcode(opcode)
+        total = median_ns(lambda: exec_loop_ns(instruction, iterations), repeats)
+        results['op.' + op_to_str(instruction[0])] = max(total - overhead, 0) / iterations
+    return results
+
+def bench_decode(repeats):
+    opcodes = []
+    for opcode in range(1 << 16):
+        try:
+            decode_opcode(opcode)
+            opcodes.append(opcode)
+        except AssertionError:
+            pass
+    def run():
+        start = time.perf_counter_ns()
+        for opcode in opcodes:
+            decode_opcode(opcode)
+        return time.perf_counter_ns() - start
+    return {'decode': median_ns(run, repeats) / len(opcodes)}
+
+def bench_roms(cycles, repeats):
+    results = {}
+    for name, data in SYNTHETIC_ROMS.items():
+        for engine, run in sorted(ENGINES.items()):
+            def run_rom():
+                state = load_rom_data(default_state(), data)
+                start = time.perf_counter_ns()
+                run_for(state, INSTRUCTIONS_PER_FRAME, max_cycles=cycles, run=run)
+                return time.perf_counter_ns() - start
+            results['rom.{}.{}'.format(name, engine)] = median_ns(run_rom, repeats) / cycles
+    return results
+
+def random_display(seed):
+    r = random.Random(seed)
+    return tuple(r.getrandbits(64) for _ in range(BASE_HEIGHT))
+
+def bench_render(frames, repeats):
+    import main as frontend
+    results = {}
+
+    state = default_state()
+    state.display = random_display(0)
+    def terminal():
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter_ns()
+            for _ in range(frames):
+                draw_to_terminal(state)
+            return time.perf_counter_ns() - start
+    results['render.terminal'] = median_ns(terminal, repeats) / frames
+
+    try:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        frontend.init_pygame()
+    except ImportError:
+        return results # no pygame, window rendering is not measured
+    window = frontend.make_window(frontend.SCALE_FACTOR)
+    for name, dirty in (('full', ALL_ROWS), ('row', 1)):
+        def draw():
+            start = time.perf_counter_ns()
+            for _ in range(frames):
+                state.dirty = dirty
+                frontend.draw_screen_impure(state, window)
+            return time.perf_counter_ns() - start
+        results['render.window.' + name] = median_ns(draw, repeats) / frames
+    return results
+
+# Only whole ROMs count as regressions, since they run long enough to time
+# reliably; everything else is only marked when it is slower. The time of an
+# op is the difference of two loop timings that are nearly the same, so its
+# noise is about as big as the time itself: an op is only marked when it is
+# also OP_NOISE_NS slower.
+GATED = 'rom.'
+OP_NOISE_NS = 100
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name in sorted(results):
+        old = baseline.get(name)
+        new = results[name]
+        if old is None or old == 0:
+            print("{:32} {:12.1f} ns".format(name, new))
+            continue
+        change = new / old - 1
+        flag = ''
+        if change > threshold and name.startswith(GATED):
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change > threshold and not (name.startswith('op.') and new - old <= OP_NOISE_NS):
+            flag = '  slower'
+        print("{:32} {:12.1f} ns {:+7.1%}{}".format(name, new, change, flag))
+    return regressions
+
+# Results kept in the repository, compared against unless told otherwise
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Chip8 emulator benchmarks")
+    parser.add_argument("--output", metavar="PATH", default="bench.json",
+                        help="write the results here as JSON (default: %(default)s)")
+    parser.add_argument("--baseline", metavar="PATH", default=BASELINE,
+                        help="compare against results written earlier by --output (default: %(default)s)")
+    parser.add_argument("--no-baseline", action="store_true",
+                        help="do not compare against anything")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error if there are regressions")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown of a synthetic ROM against the baseline counted as "
+                             "a regression (default: %(default)s)")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer iterations, for a rough check")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    (iterations, cycles, frames, repeats) = (2000, 20000, 20, 5) if args.quick else (20000, 200000, 200, 9)
+
+    results = {}
+    results.update(bench_ops(iterations, repeats))
+    results.update(bench_decode(repeats))
+    results.update(bench_roms(cycles, repeats))
+    results.update(bench_render(frames, repeats))
+
+    baseline = {}
+    if not args.no_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+
+    with open(args.output, "w") as f:
+        json.dump({'python': platform.python_version(), 'results': results}, f, indent=1, sort_keys=True)
+
+    if regressions:
+        print("{} regressions over {:.0%}".format(len(regressions), args.threshold), file=sys.stderr)
+        if args.check:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
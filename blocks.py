@@ -0,0 +1,279 @@
+# Translates straight-line Chip8 code into Python functions.
+#
+# A block starts at some address and runs up to and including the first
+# instruction that can change the control flow, draw, wait for a key or
+# write memory. Every block becomes one compiled function. Registers are
+# locals inside it: a register is loaded only if the block reads it, stored
+# only if the block writes it, and folded into a constant whenever its value
+# is known at translation time.
+#
+# Blocks live in state.blocks next to the page they were translated from,
+# exactly like state.decoded, so a write to that page makes them stale.
+# They are translated for the quirks of the machine, which never change
+# while it runs, and call its handlers.
+#
+# A block that runs past the end of a frame is cut short there, so that
+# timers tick after exactly the same instruction as in the interpreter. The
+# shorter blocks are kept under (address, length) next to the whole ones.
+from chip8 import *
+
+MAX_BLOCK_LENGTH = 64
+
+# Run by their handler as the last instruction of a block
+HANDLER_ENDS = {
+    Return, Call, JumpOffset, Display, SkipIfPressed, SkipIfNotPressed,
+    GetPressedValue, StoreRegs, HexToDecimalToIndex,
+}
+
+# Translated inline as the last instruction of a block
+INLINE_ENDS = {Jump, SkipCondEq, SkipCondNEq, SkipCondRegEq, SkipCondRegNEq}
+
+# Run by their handler in the middle of a block, with the registers they write
+HANDLER_WRITES = {
+    ClearScreen:   lambda instruction: [],
+    Random:        lambda instruction: [instruction[1]],
+    FontCharacter: lambda instruction: [],
+    LoadRegs:      lambda instruction: list(range(instruction[1] + 1)),
+}
+
+def is_const(expr):
+    return expr.isdigit()
+
+# Keeps track of where every register currently lives while a block is
+# written: only in regs, in the local vN, or as a known constant
+class BlockWriter:
+    __slots__ = ('lines', 'where', 'consts', 'dirty', 'temps')
+
+    def __init__(self):
+        self.lines  = []
+        self.where  = ['regs'] * 16
+        self.consts = [0] * 16
+        self.dirty  = [False] * 16
+        self.temps  = 0
+
+    def emit(self, line):
+        self.lines.append("    " + line)
+
+    def read(self, reg):
+        if self.where[reg] == 'const':
+            return str(self.consts[reg])
+        if self.where[reg] == 'regs':
+            self.emit("v{0:X} = regs[{0}]".format(reg))
+            self.where[reg] = 'local'
+        return "v{:X}".format(reg)
+
+    def write(self, reg, expr):
+        if is_const(expr):
+            self.where[reg]  = 'const'
+            self.consts[reg] = int(expr)
+        else:
+            self.emit("v{:X} = {}".format(reg, expr))
+            self.where[reg] = 'local'
+        self.dirty[reg] = True
+
+    def temp(self, expr): # snapshot a value before its register is overwritten
+        if is_const(expr):
+            return expr
+        name = "t{}".format(self.temps)
+        self.temps += 1
+        self.emit("{} = {}".format(name, expr))
+        return name
+
+    def flush(self):
+        for reg in range(16):
+            if self.dirty[reg]:
+                value = str(self.consts[reg]) if self.where[reg] == 'const' else "v{:X}".format(reg)
+                self.emit("regs[{}] = {}".format(reg, value))
+                self.dirty[reg] = False
+
+    def forget(self, regs):
+        for reg in regs:
+            self.where[reg] = 'regs'
+
+def fold(fmt, *operands):
+    expr = fmt.format(*operands)
+    if all(is_const(x) for x in operands):
+        return str(eval(expr))
+    return expr
+
+# Same results as the exec_* handlers of chippy, including the 8-bit wrap
+# in set_reg
+ALU_FORMATS = {
+    Add:    "({} + {}) & 255",
+    BinOr:  "{} | {}",
+    BinAnd: "{} & {}",
+    BinXor: "{} ^ {}",
+    AddR:   "({} + {}) & 255",
+    Sub12:  "({} - {}) & 255",
+}
+
+SKIP_FORMATS = {
+    SkipCondEq:     "{} == {}",
+    SkipCondNEq:    "{} != {}",
+    SkipCondRegEq:  "{} == {}",
+    SkipCondRegNEq: "{} != {}",
+}
+
+LOGIC_OPS = {BinOr, BinAnd, BinXor}
+
+# A shift by the quirks: which way 8XY6 and 8XYE go, which register they
+# read and whether a left shift sets VF to the bit shifted out
+def write_shift(writer, instruction, quirks):
+    (op, x, y) = instruction
+    old = writer.temp(writer.read(y if quirks.shift_vy else x))
+    if (op == ShiftL) == quirks.swap_shifts:
+        writer.write(x, fold("({} << 1) & 255", old))
+        writer.write(0xF, fold("{} >> 7", old) if quirks.vf_flags else "0")
+    else:
+        writer.write(x, fold("{} >> 1", old))
+        writer.write(0xF, fold("{} & 1", old))
+
+# AddR, Sub12 and Sub21 with VF set to carry and no borrow
+def write_flag_alu(writer, instruction):
+    (op, x, y) = instruction
+    (a, b) = (writer.temp(writer.read(x)), writer.temp(writer.read(y)))
+    if op == AddR:
+        writer.write(x,   fold("({} + {}) & 255", a, b))
+        writer.write(0xF, fold("({} + {}) >> 8", a, b))
+    else:
+        if op == Sub21:
+            (a, b) = (b, a)
+        writer.write(x,   fold("({} - {}) & 255", a, b))
+        writer.write(0xF, fold("int({} >= {})", a, b))
+
+def write_instruction(writer, addr, instruction, quirks):
+    op = instruction[0]
+
+    if op == Nop:
+        pass
+    elif op == Set:
+        (_, x, val) = instruction
+        writer.write(x, str(val))
+    elif op == Add:
+        (_, x, val) = instruction
+        writer.write(x, fold(ALU_FORMATS[op], writer.read(x), str(val)))
+    elif op == SetR:
+        (_, x, y) = instruction
+        writer.write(x, writer.read(y))
+    elif op in (AddR, Sub12, Sub21) and quirks.vf_flags:
+        write_flag_alu(writer, instruction)
+    elif op in ALU_FORMATS:
+        (_, x, y) = instruction
+        writer.write(x, fold(ALU_FORMATS[op], writer.read(x), writer.read(y)))
+        if op in LOGIC_OPS and quirks.logic_vf_reset:
+            writer.write(0xF, "0")
+    elif op == Sub21:
+        (_, x, y) = instruction
+        writer.write(x, fold("({} - {}) & 255", writer.read(y), writer.read(x)))
+    elif op in (ShiftL, ShiftR):
+        write_shift(writer, instruction, quirks)
+    elif op == SetIndex:
+        (_, val) = instruction
+        writer.emit("state.index = {}".format(val))
+    elif op == AddToIndex:
+        (_, x) = instruction
+        writer.emit("state.index += {}".format(writer.read(x)))
+    elif op == RegFromDelayTimer:
+        (_, x) = instruction
+        writer.write(x, "state.delay_timer")
+    elif op == DelayTimerFromReg:
+        (_, x) = instruction
+        writer.emit("state.delay_timer = {}".format(writer.read(x)))
+    elif op == SoundTimerFromReg:
+        (_, x) = instruction
+        writer.emit("state.sound_timer = {}".format(writer.read(x)))
+    elif op in HANDLER_WRITES:
+        writer.flush()
+        writer.emit("state = HANDLERS[{}](state, {!r})".format(op, instruction))
+        writer.forget(HANDLER_WRITES[op](instruction))
+    elif op == Jump:
+        (_, target) = instruction
+        writer.flush()
+        writer.emit("state.pc = {}".format(target))
+    elif op in SKIP_FORMATS:
+        (_, x, y) = instruction
+        other = writer.read(y) if op in (SkipCondRegEq, SkipCondRegNEq) else str(y)
+        cond = fold(SKIP_FORMATS[op], writer.read(x), other)
+        writer.flush()
+        if cond == "True":
+            writer.emit("state.pc = {}".format(addr + 4))
+        elif cond == "False":
+            writer.emit("state.pc = {}".format(addr + 2))
+        else:
+            writer.emit("state.pc = {} if {} else {}".format(addr + 4, cond, addr + 2))
+    else:
+        assert op in HANDLER_ENDS
+        writer.flush()
+        writer.emit("state.pc = {}".format(addr + 2))
+        writer.emit("state = HANDLERS[{}](state, {!r})".format(op, instruction))
+
+def block_instructions(memory, start, limit=MAX_BLOCK_LENGTH):
+    res = []
+    addr = start
+    while len(res) < limit:
+        # Blocks stay inside one page so that one page check validates them
+        if addr >> PAGE_BITS != start >> PAGE_BITS or addr & PAGE_MASK == PAGE_MASK:
+            break
+        try:
+            instruction = decode_opcode(memory[addr] << 8 | memory[addr + 1])
+        except AssertionError:
+            break # left to the interpreter, which reports it
+        res.append(instruction)
+        addr += 2
+        if instruction[0] in HANDLER_ENDS or instruction[0] in INLINE_ENDS:
+            break
+    return res
+
+def block_source(memory, start, quirks=DEFAULT_QUIRKS, limit=MAX_BLOCK_LENGTH):
+    instructions = block_instructions(memory, start, limit)
+    writer = BlockWriter()
+    addr = start
+    for instruction in instructions:
+        writer.emit("# {:03X}: {}".format(addr, instruction_to_str(instruction)))
+        write_instruction(writer, addr, instruction, quirks)
+        addr += 2
+    if not instructions or instructions[-1][0] not in HANDLER_ENDS | INLINE_ENDS:
+        writer.flush()
+        writer.emit("state.pc = {}".format(addr))
+    lines = ["def block(state):", "    regs = state.regs"] + writer.lines + ["    return state"]
+    return ('\n'.join(lines) + '\n', len(instructions))
+
+def translate_block(state, start, limit=MAX_BLOCK_LENGTH):
+    (source, length) = block_source(state.memory, start, state.quirks, limit)
+    namespace = {'HANDLERS': state.handlers}
+    exec(compile(source, "<block 0x{:03X}>".format(start), "exec"), namespace)
+    block = namespace['block']
+    block.source = source
+    return (state.memory.pages[start >> PAGE_BITS], block, length)
+
+# A runner for run_frame/run_for. A block that does not fit in what is left
+# of `count` runs as a shorter block of exactly what is left, so the
+# instruction count, and with it timer ticks, match the interpreter exactly.
+def run_blocks(state, count):
+    new_state = state.copy()
+    blocks = new_state.blocks
+    left = count
+    try:
+        while left > 0:
+            pc = new_state.pc
+            page = new_state.memory.pages[pc >> PAGE_BITS]
+            entry = blocks.get(pc)
+            if entry is None or entry[0] is not page:
+                entry = translate_block(new_state, pc)
+                blocks[pc] = entry
+            if entry[2] > left:
+                entry = blocks.get((pc, left))
+                if entry is None or entry[0] is not page:
+                    entry = translate_block(new_state, pc, left)
+                    blocks[(pc, left)] = entry
+            (_, block, length) = entry
+            if length == 0:
+                new_state = fetch_decode_exec(new_state)
+                left -= 1
+            else:
+                new_state = block(new_state)
+                left -= length
+    except WaitingForKey:
+        pass
+    new_state.cycles += count
+    return new_state
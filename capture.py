@@ -0,0 +1,245 @@
+# Records frames to files on a background thread: a numbered PNG per frame,
+# one animated GIF, or raw, the 256 bytes of display_to_bytes() per frame
+# back to back. Everything is encoded with the standard library alone.
+#
+# The emulator only hands over the display tuple, which is immutable, so
+# nothing is copied while it runs. The queue to the worker is bounded:
+# when it is full a frame is dropped and counted, or with `block` the
+# emulator waits for the worker instead. The worker is a thread, not a
+# process, since handing it a frame costs next to nothing that way; PNG and
+# raw frames take it well under a millisecond, GIF frames a few.
+#
+# Frames are numbered by when they were shown, 60 per second, so dropped
+# frames leave gaps in the PNG numbers and make the GIF hold the frame
+# before a little longer. The GIF only stores a frame when the display
+# changed, which keeps it small and the worker fast.
+import os
+import zlib
+import queue
+import struct
+import threading
+from chip8 import *
+
+CAPTURE_FORMATS = ('png', 'gif', 'raw')
+
+class Capture:
+    __slots__ = ('queue', 'thread', 'every', 'block', 'shown', 'captured', 'dropped', 'error')
+
+    def __init__(self, size, every, block):
+        self.queue    = queue.Queue(size)
+        self.thread   = None
+        self.every    = every # capture one frame of every `every`
+        self.block    = block # wait for the worker when the queue is full instead of dropping
+        self.shown    = 0 # frames shown so far
+        self.captured = 0
+        self.dropped  = 0
+        self.error    = None # what stopped the worker, if anything did
+
+def capture_format(path): # by the extension, raw for anything else
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    return ext if ext in CAPTURE_FORMATS else 'raw'
+
+def start_capture(path, scale=4, every=1, size=256, block=False):
+    capture = Capture(size, every, block)
+    encoder = {'png': PngWriter, 'gif': GifWriter, 'raw': RawWriter}[capture_format(path)]
+    writer = encoder(path, scale, every)
+    capture.thread = threading.Thread(target=capture_worker, args=(capture, writer),
+                                      name="capture", daemon=True)
+    capture.thread.start()
+    return capture
+
+def capture_frame(capture, state):
+    number = capture.shown
+    capture.shown += 1
+    if number % capture.every != 0:
+        return
+    item = (number, state.display)
+    if capture.block:
+        capture.queue.put(item)
+    else:
+        try:
+            capture.queue.put_nowait(item)
+        except queue.Full:
+            capture.dropped += 1
+            return
+    capture.captured += 1
+
+def stop_capture(capture): # waits for the worker to write what is queued
+    capture.queue.put(None)
+    capture.thread.join()
+    if capture.error is not None:
+        raise capture.error
+
+def capture_report(capture):
+    return "{} frames captured, {} dropped".format(capture.captured, capture.dropped)
+
+def capture_worker(capture, writer):
+    try:
+        while True:
+            item = capture.queue.get()
+            if item is None:
+                break
+            writer.write(*item)
+        writer.close()
+    except Exception as e:
+        capture.error = e
+        # Keep emptying the queue, so that a blocking capture does not hang
+        while capture.queue.get() is not None:
+            pass
+
+# A display row scaled up `scale` times, as bytes with 8 pixels each, the
+# leftmost in the top bit, as PNG wants them
+def scaled_row(row, scale, spread):
+    if scale == 1:
+        return row.to_bytes(8, 'big')
+    return b''.join(spread[(row >> (56 - 8 * i)) & 0xFF] for i in range(8))
+
+def spread_table(scale): # byte -> its bits each repeated `scale` times
+    table = []
+    for byte in range(256):
+        bits = 0
+        for x in range(8):
+            bit = (byte >> (7 - x)) & 1
+            bits = (bits << scale) | (bit * ((1 << scale) - 1))
+        table.append(bits.to_bytes(scale, 'big'))
+    return table
+
+PIXEL_BYTES = [bytes((byte >> (7 - x)) & 1 for x in range(8)) for byte in range(256)]
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+# One 1-bit grayscale image per frame, white pixels on black
+class PngWriter:
+    __slots__ = ('path', 'scale', 'spread')
+
+    def __init__(self, path, scale, every):
+        self.path   = path
+        self.scale  = scale
+        self.spread = spread_table(scale)
+
+    def frame_path(self, number): # pong.png -> pong-000042.png
+        (stem, ext) = os.path.splitext(self.path)
+        return "{}-{:06}{}".format(stem, number, ext)
+
+    def write(self, number, display):
+        scale = self.scale
+        rows = []
+        for row in display:
+            line = b'\x00' + scaled_row(row, scale, self.spread) # filter type 0, none
+            rows += [line] * scale
+        header = struct.pack('>IIBBBBB', BASE_WIDTH * scale, BASE_HEIGHT * scale, 1, 0, 0, 0, 0)
+        with open(self.frame_path(number), "wb") as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header)
+                    + png_chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) + png_chunk(b'IEND', b''))
+
+    def close(self):
+        pass
+
+class RawWriter:
+    __slots__ = ('file', )
+
+    def __init__(self, path, scale, every):
+        self.file = open(path, "wb")
+
+    def write(self, number, display):
+        self.file.write(display_to_bytes(display))
+
+    def close(self):
+        self.file.close()
+
+GIF_MIN_CODE_SIZE = 2 # the smallest GIF allows, for two colours
+GIF_MAX_CODES     = 4096
+
+# LZW as GIF does it: variable-width codes, packed from the lowest bit up
+def gif_lzw(pixels):
+    clear = 1 << GIF_MIN_CODE_SIZE
+    end   = clear + 1
+    out = bytearray()
+    width = GIF_MIN_CODE_SIZE + 1
+    (bits, nbits) = (clear, width)
+    table = {}
+    next_code = end + 1
+    prefix = pixels[0]
+    for i in range(1, len(pixels)):
+        key = (prefix << 1) | pixels[i]
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        bits |= prefix << nbits
+        nbits += width
+        if next_code == GIF_MAX_CODES: # the table is full, start a new one
+            bits |= clear << nbits
+            nbits += width
+            table = {}
+            next_code = end + 1
+            width = GIF_MIN_CODE_SIZE + 1
+        else:
+            table[key] = next_code
+            if next_code == 1 << width:
+                width += 1
+            next_code += 1
+        while nbits >= 8:
+            out.append(bits & 0xFF)
+            bits >>= 8
+            nbits -= 8
+        prefix = pixels[i]
+    bits |= prefix << nbits
+    nbits += width
+    if next_code == 1 << width and next_code < GIF_MAX_CODES: # as the decoder does after the last code
+        width += 1
+    bits |= end << nbits
+    nbits += width
+    return bytes(out) + bits.to_bytes((nbits + 7) // 8, 'little')
+
+def gif_blocks(data): # data sub-blocks of at most 255 bytes, then the terminator
+    return b''.join(bytes([len(data[i:i + 255])]) + data[i:i + 255]
+                    for i in range(0, len(data), 255)) + b'\x00'
+
+def centiseconds(number): # GIF delays are in 1/100 s, frames are 1/60 s
+    return number * 100 // FRAME_RATE
+
+# A frame is written once the next different one arrives, so that its delay
+# covers every frame it stayed on the screen
+class GifWriter:
+    __slots__ = ('file', 'scale', 'spread', 'every', 'pending', 'last')
+
+    def __init__(self, path, scale, every):
+        self.file    = open(path, "wb")
+        self.scale   = scale
+        self.spread  = spread_table(scale)
+        self.every   = every
+        self.pending = None # (number, display) not written yet
+        self.last    = 0 # number of the last frame written or not
+        (width, height) = (BASE_WIDTH * scale, BASE_HEIGHT * scale)
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0x80, 0, 0)
+                        + b'\x00\x00\x00\xff\xff\xff' # global palette: black, white
+                        + b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00') # loop forever
+
+    def write(self, number, display):
+        self.last = number
+        if self.pending is not None and self.pending[1] == display:
+            return
+        if self.pending is not None:
+            self.write_frame(self.pending, number)
+        self.pending = (number, display)
+
+    def write_frame(self, frame, until):
+        (number, display) = frame
+        scale = self.scale
+        lines = []
+        for row in display: # a byte per pixel, 0 or 1, the palette entry
+            line = b''.join(PIXEL_BYTES[byte] for byte in scaled_row(row, scale, self.spread))
+            lines += [line] * scale
+        pixels = b''.join(lines)
+        delay = centiseconds(until) - centiseconds(number)
+        self.file.write(b'\x21\xf9\x04\x00' + struct.pack('<H', delay) + b'\x00\x00' # control
+                        + b'\x2c' + struct.pack('<HHHHB', 0, 0, BASE_WIDTH * scale, BASE_HEIGHT * scale, 0)
+                        + bytes([GIF_MIN_CODE_SIZE]) + gif_blocks(gif_lzw(pixels)))
+
+    def close(self):
+        if self.pending is not None:
+            self.write_frame(self.pending, self.last + self.every)
+        self.file.write(b'\x3b')
+        self.file.close()
@@ -0,0 +1,1267 @@
+import math
+import hashlib
+import struct
+from array import array
+from collections import namedtuple
+
+BASE_WIDTH  = 64
+BASE_HEIGHT = 32
+
+FRAME_RATE = 60 # timers tick once per frame
+FRAME_TIME = 1 / FRAME_RATE
+INSTRUCTIONS_PER_FRAME = 12 # 720 instructions per second
+
+_KB = 1024
+_4KB = 4 * _KB
+
+main_memory = [0] * _4KB
+
+def empty_display(): # 64 pixels wide * 32 pixels tall, a row is a 64-bit int
+    return (0, ) * 32
+
+def pixel(row, x): # the leftmost pixel is the most significant bit
+    return (row >> (63 - x)) & 1
+
+ALL_ROWS = (1 << 32) - 1
+
+def changed_rows(old_display, new_display): # bit N is set if row N differs
+    mask = 0
+    for y, (old, new) in enumerate(zip(old_display, new_display)):
+        if old != new:
+            mask |= 1 << y
+    return mask
+
+def dirty_runs(mask): # [(first_row, end_row)] for every run of set bits
+    runs = []
+    y = 0
+    while mask >> y:
+        if (mask >> y) & 1 == 0:
+            y += 1
+            continue
+        start = y
+        while (mask >> y) & 1 == 1:
+            y += 1
+        runs.append((start, y))
+    return runs
+
+# The stack is a linked list of (top, depth, rest) cells, so pushing and
+# popping never copy it and older states keep their own stack for free
+def empty_stack():
+    return None
+
+def stack_depth(stack):
+    return 0 if stack is None else stack[1]
+
+def safe_push(stack, x):
+    depth = stack_depth(stack) + 1
+    assert depth <= 16
+    return (x, depth, stack)
+
+def safe_pop(stack):
+    assert stack_depth(stack) > 0
+    return stack[2]
+
+def top(stack):
+    assert stack_depth(stack) > 0
+    return stack[0]
+
+def stack_to_list(stack): # bottom first
+    res = []
+    while stack is not None:
+        res.append(stack[0])
+        stack = stack[2]
+    return res[::-1]
+
+def empty_memory():
+    return bytearray(_4KB)
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+# Memory is a tuple of immutable pages. A write replaces only the pages it
+# touches, every other page is shared with the memory it was made from.
+class Memory:
+    __slots__ = ('pages', )
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __len__(self):
+        return len(self.pages) << PAGE_BITS
+
+    def __getitem__(self, addr):
+        if type(addr) is slice:
+            return bytes(self)[addr]
+        return self.pages[addr >> PAGE_BITS][addr & PAGE_MASK]
+
+    def __bytes__(self):
+        return b''.join(self.pages)
+
+def memory_from_bytes(data):
+    assert len(data) % PAGE_SIZE == 0
+    return Memory(tuple(bytes(data[x : x + PAGE_SIZE]) for x in range(0, len(data), PAGE_SIZE)))
+
+def memory_write(memory, addr, values):
+    pages = list(memory.pages)
+    for i, val in enumerate(values):
+        page = (addr + i) >> PAGE_BITS
+        if pages[page] is memory.pages[page]:
+            pages[page] = bytearray(pages[page])
+        pages[page][(addr + i) & PAGE_MASK] = val
+    for page, data in enumerate(pages):
+        if data is not memory.pages[page]:
+            pages[page] = bytes(data)
+    return Memory(tuple(pages))
+
+def empty_regs():
+    return array('B', [0] * 16)
+
+def reg_value(state, reg):
+    regs = state.regs
+    assert reg < len(regs)
+    return regs[reg]
+
+def set_reg(state, reg, value):
+    new_state = state
+    regs = new_state.regs
+    assert reg < len(regs)
+    assert value < 2**15 and value >= -(2 ** 15)
+    regs[reg] = value & 0xFF
+    new_state.regs = regs
+    return new_state
+
+def memory_with_loaded_fonts(_mem):
+    mem = _mem[:]
+    assert len(mem) == 4096
+    [
+            (_0_start, _0_end),
+            (_1_start, _1_end),
+            (_2_start, _2_end),
+            (_3_start, _3_end),
+            (_4_start, _4_end),
+            (_5_start, _5_end),
+            (_6_start, _6_end),
+            (_7_start, _7_end),
+            (_8_start, _8_end),
+            (_9_start, _9_end),
+            (_A_start, _A_end),
+            (_B_start, _B_end),
+            (_C_start, _C_end),
+            (_D_start, _D_end),
+            (_E_start, _E_end),
+            (_F_start, _F_end)
+    ] = [(x, x + 5) for x in range(0x50, 0x9F, 5)[:16]]
+    
+    assert _0_start == 0x50 and _F_end == 0xA0
+
+    _0 = [0xF0, 0x90, 0x90, 0x90, 0xF0]; mem[_0_start : _0_end] = _0
+    _1 = [0x20, 0x60, 0x20, 0x20, 0x70]; mem[_1_start : _1_end] = _1
+    _2 = [0xF0, 0x10, 0xF0, 0x80, 0xF0]; mem[_2_start : _2_end] = _2
+    _3 = [0xF0, 0x10, 0xF0, 0x10, 0xF0]; mem[_3_start : _3_end] = _3
+    _4 = [0x90, 0x90, 0xF0, 0x10, 0x10]; mem[_4_start : _4_end] = _4
+    _5 = [0xF0, 0x80, 0xF0, 0x10, 0xF0]; mem[_5_start : _5_end] = _5
+    _6 = [0xF0, 0x80, 0xF0, 0x90, 0xF0]; mem[_6_start : _6_end] = _6
+    _7 = [0xF0, 0x10, 0x20, 0x40, 0x40]; mem[_7_start : _7_end] = _7
+    _8 = [0xF0, 0x90, 0xF0, 0x90, 0xF0]; mem[_8_start : _8_end] = _8
+    _9 = [0xF0, 0x90, 0xF0, 0x10, 0xF0]; mem[_9_start : _9_end] = _9
+    _A = [0xF0, 0x90, 0xF0, 0x90, 0x90]; mem[_A_start : _A_end] = _A
+    _B = [0xE0, 0x90, 0xE0, 0x90, 0xE0]; mem[_B_start : _B_end] = _B
+    _C = [0xF0, 0x80, 0x80, 0x80, 0xF0]; mem[_C_start : _C_end] = _C
+    _D = [0xE0, 0x90, 0x90, 0x90, 0xE0]; mem[_D_start : _D_end] = _D
+    _E = [0xF0, 0x80, 0xE0, 0x80, 0xF0]; mem[_E_start : _E_end] = _E
+    _F = [0xF0, 0x80, 0xF0, 0x80, 0x80]; mem[_F_start : _F_end] = _F
+
+    assert len(mem) == 4096
+
+    return mem
+
+def memory_with_loaded_fonts_from_state(state):
+    mem = bytearray(bytes(state.memory))
+    return memory_from_bytes(memory_with_loaded_fonts(mem))
+
+# Memory is immutable, so every machine starts from this same one
+FONT_MEMORY = memory_from_bytes(memory_with_loaded_fonts(empty_memory()))
+
+class Machine:
+    __slots__ = (
+        'is_running',
+        'pc',
+        'index',
+        'sound_timer',
+        'delay_timer',
+        'memory',
+        'display',
+        'stack',
+        'regs',
+        'keys',
+        'decoded',
+        'dirty',
+        'cycles',
+        'blocks',
+        'rng',
+        'idle',
+        'quirks',
+        'handlers',
+    )
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    # Lets code written against the old dict state keep using state['pc']
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    # Everything but regs is immutable and can be shared between states
+    def copy(self):
+        new = Machine.__new__(Machine)
+        for name in Machine.__slots__:
+            setattr(new, name, getattr(self, name))
+        new.regs = self.regs[:]
+        return new
+
+# Every machine has its own random number generator, a xorshift32 whose
+# state is an int in state.rng, so a run depends only on its seed and input
+DEFAULT_SEED = 0
+
+def seed_rng(seed):
+    return ((seed * 0x9E3779B1 + 0x7F4A7C15) & 0xFFFFFFFF) or 1 # never 0
+
+def next_random(rng):
+    rng ^= (rng << 13) & 0xFFFFFFFF
+    rng ^= rng >> 17
+    rng ^= (rng << 5) & 0xFFFFFFFF
+    return rng
+
+# Chip8 variants do a few instructions differently. A profile says how each
+# of them behaves, and the handlers for a profile are put together once, by
+# quirk_handlers(), so no instruction ever checks the profile while it runs.
+Quirks = namedtuple('Quirks', (
+    'swap_shifts',     # 8XY6 shifts left and 8XYE right, as chippy always did
+    'vf_flags',        # 8XY4/5/7 set VF to carry and no borrow, left shifts to the bit shifted out
+    'shift_vy',        # shifts read VY instead of VX
+    'logic_vf_reset',  # 8XY1/2/3 clear VF
+    'index_increment', # what FX55 and FX65 add to I: 'none', 'x' or 'x+1'
+    'jump_vx',         # BXNN jumps to XNN + VX instead of NNN + V0
+    'sprite_wrap',     # sprites wrap around the edges instead of being clipped
+))
+
+INDEX_INCREMENTS = ('none', 'x', 'x+1')
+
+QUIRK_PROFILES = {
+    'chippy': Quirks(swap_shifts=True, vf_flags=False, shift_vy=False, logic_vf_reset=False,
+                     index_increment='none', jump_vx=False, sprite_wrap=False),
+    'vip':    Quirks(swap_shifts=False, vf_flags=True, shift_vy=True, logic_vf_reset=True,
+                     index_increment='x+1', jump_vx=False, sprite_wrap=False),
+    'chip48': Quirks(swap_shifts=False, vf_flags=True, shift_vy=False, logic_vf_reset=False,
+                     index_increment='x', jump_vx=True, sprite_wrap=False),
+    'schip':  Quirks(swap_shifts=False, vf_flags=True, shift_vy=False, logic_vf_reset=False,
+                     index_increment='none', jump_vx=True, sprite_wrap=False),
+}
+
+DEFAULT_QUIRKS = QUIRK_PROFILES['chippy']
+
+# A profile name, optionally followed by quirks that differ from it:
+# "schip" or "schip,sprite_wrap=1,index_increment=x"
+def parse_quirks(spec):
+    (name, *overrides) = spec.split(',')
+    if name not in QUIRK_PROFILES:
+        raise ValueError("No quirk profile {}, there are {}".format(name, ', '.join(QUIRK_PROFILES)))
+    quirks = QUIRK_PROFILES[name]
+    for override in overrides:
+        (field, _, value) = override.partition('=')
+        if field not in Quirks._fields:
+            raise ValueError("No quirk {}".format(field))
+        if field == 'index_increment':
+            if value not in INDEX_INCREMENTS:
+                raise ValueError("index_increment is one of {}".format(', '.join(INDEX_INCREMENTS)))
+        elif value in ('0', '1'):
+            value = value == '1'
+        else:
+            raise ValueError("{} is 0 or 1".format(field))
+        quirks = quirks._replace(**{field: value})
+    return quirks
+
+def default_state(seed=DEFAULT_SEED, quirks=DEFAULT_QUIRKS):
+    return Machine(
+        is_running  = True,
+        pc          = 0x200, # program counter
+        index       = 0,
+        sound_timer = 0,
+        delay_timer = 0,
+        memory      = FONT_MEMORY,
+        display     = empty_display(),
+        stack       = empty_stack(), # stack for subroutines
+        regs        = empty_regs(),
+        keys        = 0, # bit N is set while key N is held
+        decoded     = {}, # address -> (page, handler, instruction)
+        dirty       = ALL_ROWS, # display rows changed since the last present
+        cycles      = 0, # instructions executed so far
+        blocks      = {}, # address -> (page, function, length), see blocks.py
+        rng         = seed_rng(seed),
+        idle        = None, # (addresses of the loop, uses the timers) in an idle loop, see idle.py
+        quirks      = quirks,
+        handlers    = quirk_handlers(quirks), # indexed by op
+    )
+
+
+def fetch_opcode(state):
+    new_state = state
+    pc  = state.pc
+    mem = state.memory
+    op1, op2 = mem[pc], mem[pc + 1]
+    new_state.pc = pc + 2
+    return (op1 << 8 | op2, new_state)
+
+( Nop
+, ClearScreen
+, Return
+, Jump
+, Call
+, SkipCondEq
+, SkipCondNEq
+, SkipCondRegEq
+, SkipCondRegNEq
+, Set
+, Add
+, SetR
+, BinOr
+, BinAnd
+, BinXor
+, AddR
+, Sub12
+, Sub21
+, ShiftL
+, ShiftR
+, SetIndex
+, JumpOffset
+, Random
+, Display
+, SkipIfPressed
+, SkipIfNotPressed
+, RegFromDelayTimer
+, DelayTimerFromReg
+, SoundTimerFromReg
+, AddToIndex
+, GetPressedValue
+, FontCharacter
+, HexToDecimalToIndex
+, StoreRegs
+, LoadRegs 
+) = range(35)
+
+OP_NAMES = (
+    "Nop",
+    "ClearScreen",
+    "Return",
+    "Jump",
+    "Call",
+    "SkipCondEq",
+    "SkipCondNEq",
+    "SkipCondRegEq",
+    "SkipCondRegNEq",
+    "Set",
+    "Add",
+    "SetR",
+    "BinOr",
+    "BinAnd",
+    "BinXor",
+    "AddR",
+    "Sub12",
+    "Sub21",
+    "ShiftL",
+    "ShiftR",
+    "SetIndex",
+    "JumpOffset",
+    "Random",
+    "Display",
+    "SkipIfPressed",
+    "SkipIfNotPressed",
+    "RegFromDelayTimer",
+    "DelayTimerFromReg",
+    "SoundTimerFromReg",
+    "AddToIndex",
+    "GetPressedValue",
+    "FontCharacter",
+    "HexToDecimalToIndex",
+    "StoreRegs",
+    "LoadRegs",
+)
+
+def op_to_str(op):
+    if op >= 0 and op < len(OP_NAMES):
+        return OP_NAMES[op]
+    return "Undefined"
+
+def instruction_to_str(x):
+    res = str(tuple([op_to_str(x[0])] + list(x)[1:]))
+    return res
+
+def first_digit (opcode): return opcode >> 12
+def second_digit(opcode): return (opcode >> 8) & 15
+def third_digit (opcode): return (opcode >> 4) & 15
+def fourth_digit(opcode): return opcode & 15
+
+def last_three  (opcode): return opcode & ((1 << 12) - 1)
+def last_two    (opcode): return opcode & ((1 << 8) - 1)
+
+def opcode_in_hex(opcode):
+    return "0x{:04X}".format(opcode)
+
+def unknown_instruction(opcode):
+    assert False, "Unknown instruction! {}".format(opcode_in_hex(opcode))
+
+def decode_0(opcode):
+    if opcode == 0x00E0:
+        return (ClearScreen, )
+    if opcode == 0x00EE:
+        return (Return, )
+    return (Nop, )
+
+def decode_addr(op):
+    return lambda opcode: (op, last_three(opcode))
+
+def decode_reg_val(op):
+    return lambda opcode: (op, second_digit(opcode), last_two(opcode))
+
+def decode_reg_reg(op):
+    return lambda opcode: (op, second_digit(opcode), third_digit(opcode))
+
+# 0x8XYN, indexed by N
+ALU_OPS = [SetR, BinOr, BinAnd, BinXor, AddR, Sub12, ShiftL, Sub21,
+           None, None, None, None, None, None, ShiftR, None]
+
+def decode_8(opcode):
+    op = ALU_OPS[fourth_digit(opcode)]
+    if op is None:
+        return unknown_instruction(opcode)
+    return (op, second_digit(opcode), third_digit(opcode))
+
+def decode_d(opcode):
+    return (Display, second_digit(opcode), third_digit(opcode), fourth_digit(opcode))
+
+# 0xEXNN, indexed by NN
+KEY_OPS = {0x9E: SkipIfPressed, 0xA1: SkipIfNotPressed}
+
+def decode_e(opcode):
+    op = KEY_OPS.get(last_two(opcode))
+    if op is None:
+        return unknown_instruction(opcode)
+    return (op, second_digit(opcode))
+
+# 0xFXNN, indexed by NN
+MISC_OPS = {
+    0x07: RegFromDelayTimer,
+    0x15: DelayTimerFromReg,
+    0x18: SoundTimerFromReg,
+    0x1E: AddToIndex,
+    0x0A: GetPressedValue,
+    0x29: FontCharacter,
+    0x33: HexToDecimalToIndex,
+    0x55: StoreRegs,
+    0x65: LoadRegs,
+}
+
+def decode_f(opcode):
+    op = MISC_OPS.get(last_two(opcode))
+    if op is None:
+        return unknown_instruction(opcode)
+    return (op, second_digit(opcode))
+
+# Indexed by the first digit of the opcode
+DECODERS = [
+    decode_0,
+    decode_addr(Jump),
+    decode_addr(Call),
+    decode_reg_val(SkipCondEq),
+    decode_reg_val(SkipCondNEq),
+    decode_reg_reg(SkipCondRegEq),
+    decode_reg_val(Set),
+    decode_reg_val(Add),
+    decode_8,
+    decode_reg_reg(SkipCondRegNEq),
+    decode_addr(SetIndex),
+    decode_addr(JumpOffset),
+    decode_reg_val(Random),
+    decode_d,
+    decode_e,
+    decode_f,
+]
+
+def decode_opcode(opcode):
+    assert opcode >= 0 and opcode < 2 ** 16
+    return DECODERS[first_digit(opcode)](opcode)
+
+def exec_nop(state, instruction):
+    return state
+
+def exec_clear_screen(state, instruction):
+    new_state = state
+    display = empty_display()
+    new_state.dirty |= changed_rows(new_state.display, display)
+    new_state.display = display
+    return new_state
+
+def exec_return(state, instruction):
+    new_state = state
+    stack = new_state.stack
+    pc = top(stack)
+    stack = safe_pop(stack)
+    new_state.stack = stack
+    new_state.pc    = pc
+    return new_state
+
+def exec_jump(state, instruction):
+    new_state = state
+    (_, new_pc) = instruction
+    new_state.pc = new_pc
+    return new_state
+
+def exec_call(state, instruction):
+    new_state = state
+    (_, new_pc) = instruction
+    stack = safe_push(new_state.stack, new_state.pc)
+    new_state.pc = new_pc
+    new_state.stack = stack
+    return new_state
+
+def exec_skip_cond_eq(state, instruction):
+    new_state = state
+    (_, reg, val) = instruction
+    reg_val = reg_value(new_state, reg)
+    if reg_val == val:
+        new_state.pc = new_state.pc + 2
+    return new_state
+
+def exec_skip_cond_neq(state, instruction):
+    new_state = state
+    (_, reg, val) = instruction
+    reg_val = reg_value(new_state, reg)
+    if reg_val != val:
+        new_state.pc = new_state.pc + 2
+    return new_state
+
+def exec_skip_cond_reg_eq(state, instruction):
+    new_state = state
+    (_, reg1, reg2) = instruction
+    reg_val1 = reg_value(new_state, reg1)
+    reg_val2 = reg_value(new_state, reg2)
+    if reg_val1 == reg_val2:
+        new_state.pc = new_state.pc + 2
+    return new_state
+
+def exec_skip_cond_reg_neq(state, instruction):
+    new_state = state
+    (_, reg1, reg2) = instruction
+    reg_val1 = reg_value(new_state, reg1)
+    reg_val2 = reg_value(new_state, reg2)
+    if reg_val1 != reg_val2:
+        new_state.pc = new_state.pc + 2
+    return new_state
+
+def exec_set(state, instruction):
+    (_, reg, val) = instruction
+    return set_reg(state, reg, val)
+
+def exec_add(state, instruction):
+    (_, reg, val) = instruction
+    reg_val = reg_value(state, reg) + val
+    return set_reg(state, reg, reg_val)
+
+def exec_set_r(state, instruction):
+    (_, reg1, reg2) = instruction
+    reg_val2 = reg_value(state, reg2)
+    return set_reg(state, reg1, reg_val2)
+
+def exec_bin_or(state, instruction):
+    (_, reg1, reg2) = instruction
+    new_val = reg_value(state, reg1) | reg_value(state, reg2)
+    return set_reg(state, reg1, new_val)
+
+def exec_bin_and(state, instruction):
+    (_, reg1, reg2) = instruction
+    new_val = reg_value(state, reg1) & reg_value(state, reg2)
+    return set_reg(state, reg1, new_val)
+
+def exec_bin_xor(state, instruction):
+    (_, reg1, reg2) = instruction
+    new_val = reg_value(state, reg1) ^ reg_value(state, reg2)
+    return set_reg(state, reg1, new_val)
+
+def exec_add_r(state, instruction):
+    (_, reg1, reg2) = instruction
+    new_val = reg_value(state, reg1) + reg_value(state, reg2)
+    return set_reg(state, reg1, new_val)
+
+def exec_sub12(state, instruction):
+    (_, reg1, reg2) = instruction
+    new_val = reg_value(state, reg1) - reg_value(state, reg2)
+    return set_reg(state, reg1, new_val)
+
+def exec_sub21(state, instruction):
+    (_, reg1, reg2) = instruction
+    new_val = reg_value(state, reg2) - reg_value(state, reg1)
+    return set_reg(state, reg1, new_val)
+
+def exec_shift_l(state, instruction):
+    (_, reg1, reg2) = instruction
+    reg_val1 = reg_value(state, reg1)
+    new_val = reg_val1 << 1
+    shifted_out = reg_val1 & (1 << 15)
+    new_state = set_reg(state, reg1, new_val)
+    new_state = set_reg(new_state, 0xF, shifted_out)
+    return new_state
+
+def exec_shift_r(state, instruction):
+    (_, reg1, reg2) = instruction
+    reg_val1 = reg_value(state, reg1)
+    new_val = reg_val1 >> 1
+    shifted_out = reg_val1 & 1
+    new_state = set_reg(state, reg1, new_val)
+    new_state = set_reg(new_state, 0xF, shifted_out)
+    return new_state
+
+def exec_set_index(state, instruction):
+    new_state = state
+    (_, val) = instruction
+    new_state.index = val
+    return new_state
+
+def exec_jump_offset(state, instruction):
+    new_state = state
+    (_, val) = instruction
+    reg_val0 = reg_value(new_state, 0x0)
+    new_state.pc = val + reg_val0
+    return new_state
+
+def exec_random(state, instruction):
+    new_state = state
+    (_, reg, val) = instruction
+    new_state.rng = next_random(new_state.rng)
+    return set_reg(new_state, reg, (new_state.rng >> 24) & val)
+
+# A sprite row is a byte, so shifted up to the top of a 64-bit row and then
+# right by x it lines up with the display row, and the pixels past the right
+# edge fall off. One XOR draws the row and one AND tells if it erased any.
+def exec_display(state, instruction):
+    new_state = state
+    (_, rx, ry, h) = instruction
+    x = reg_value(new_state, rx) & 63
+    y = reg_value(new_state, ry) & 31
+
+    set_vf = 0
+    dirty  = 0
+
+    display = list(new_state.display)
+    index   = new_state.index
+    memory  = new_state.memory
+
+    for i in range(min(h, 32 - y)):
+        sprite = (memory[index + i] << 56) >> x
+        if sprite == 0:
+            continue
+        row = display[y + i]
+        if row & sprite:
+            set_vf = 1
+        display[y + i] = row ^ sprite
+        dirty |= 1 << (y + i)
+
+    if dirty:
+        new_state.display = tuple(display)
+        new_state.dirty |= dirty
+    new_state = set_reg(new_state, 0xF, set_vf)
+    return new_state
+
+def exec_skip_if_pressed(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    assert reg >= 0 and reg < 16
+    reg_val = reg_value(new_state, reg)
+    if (new_state.keys >> reg_val) & 1 == 1:
+        new_state.pc += 2
+    return new_state
+
+def exec_skip_if_not_pressed(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    assert reg >= 0 and reg < 16
+    reg_val = reg_value(new_state, reg)
+    if (new_state.keys >> reg_val) & 1 == 0:
+        new_state.pc += 2
+    return new_state
+
+def exec_reg_from_delay_timer(state, instruction):
+    (_, reg) = instruction
+    return set_reg(state, reg, state.delay_timer)
+
+def exec_delay_timer_from_reg(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    reg_val = reg_value(new_state, reg)
+    new_state.delay_timer = reg_val
+    return new_state
+
+def exec_sound_timer_from_reg(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    reg_val = reg_value(new_state, reg)
+    new_state.sound_timer = reg_val
+    return new_state
+
+def exec_add_to_index(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    reg_val = reg_value(new_state, reg)
+    new_state.index += reg_val
+    return new_state
+
+# Raised by GetPressedValue while no key is held. Keys only change between
+# runs, so until then the machine would run the same instruction over and
+# over: the runners catch it and count the rest of the run as done.
+class WaitingForKey(Exception):
+    pass
+
+def exec_get_pressed_value(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    keys = new_state.keys
+    if keys != 0:
+        lowest = (keys & -keys).bit_length() - 1
+        return set_reg(new_state, reg, lowest)
+
+    new_state.pc -= 2
+    raise WaitingForKey()
+
+def exec_font_character(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    reg_val = reg_value(new_state, reg)
+    assert reg_val >= 0 and reg_val < 16
+    new_state.index = reg_val * 5 + 0x50
+    return new_state
+
+def exec_hex_to_decimal_to_index(state, instruction):
+    new_state = state
+    (_, reg) = instruction
+    reg_val = reg_value(new_state, reg)
+    digits = [reg_val // 100, (reg_val // 10) % 10, reg_val % 10]
+    new_state.memory = memory_write(new_state.memory, new_state.index, digits)
+    return new_state
+
+def exec_store_regs(state, instruction):
+    new_state = state
+    (_, end) = instruction
+    regs = new_state.regs[:end + 1]
+    new_state.memory = memory_write(new_state.memory, new_state.index, regs)
+    return new_state
+
+def exec_load_regs(state, instruction):
+    new_state = state
+    (_, end) = instruction
+    regs = new_state.regs
+    memory = new_state.memory
+    index = new_state.index
+    for i in range(end + 1):
+        regs[i] = memory[index + i]
+    new_state.regs = regs
+    return new_state
+
+# The handlers of the quirks that differ from chippy's
+
+def exec_add_r_carry(state, instruction):
+    (_, reg1, reg2) = instruction
+    total = reg_value(state, reg1) + reg_value(state, reg2)
+    new_state = set_reg(state, reg1, total)
+    return set_reg(new_state, 0xF, total >> 8)
+
+def exec_sub12_borrow(state, instruction):
+    (_, reg1, reg2) = instruction
+    (val1, val2) = (reg_value(state, reg1), reg_value(state, reg2))
+    new_state = set_reg(state, reg1, val1 - val2)
+    return set_reg(new_state, 0xF, int(val1 >= val2))
+
+def exec_sub21_borrow(state, instruction):
+    (_, reg1, reg2) = instruction
+    (val1, val2) = (reg_value(state, reg1), reg_value(state, reg2))
+    new_state = set_reg(state, reg1, val2 - val1)
+    return set_reg(new_state, 0xF, int(val2 >= val1))
+
+# `source` is the instruction field of the register shifted, 1 for VX and 2
+# for VY. Left shifts set VF to the bit shifted out only with `carry` 1.
+def make_shift(left, source, carry):
+    if left:
+        def exec_shift(state, instruction):
+            reg_val = reg_value(state, instruction[source])
+            new_state = set_reg(state, instruction[1], reg_val << 1)
+            return set_reg(new_state, 0xF, (reg_val >> 7) & carry)
+    else:
+        def exec_shift(state, instruction):
+            reg_val = reg_value(state, instruction[source])
+            new_state = set_reg(state, instruction[1], reg_val >> 1)
+            return set_reg(new_state, 0xF, reg_val & 1)
+    return exec_shift
+
+def with_vf_reset(handler):
+    def exec_and_reset_vf(state, instruction):
+        return set_reg(handler(state, instruction), 0xF, 0)
+    return exec_and_reset_vf
+
+def with_index_increment(handler, extra):
+    def exec_and_increment_index(state, instruction):
+        new_state = handler(state, instruction)
+        new_state.index += instruction[1] + extra
+        return new_state
+    return exec_and_increment_index
+
+def exec_jump_offset_vx(state, instruction):
+    new_state = state
+    (_, val) = instruction
+    new_state.pc = val + reg_value(new_state, val >> 8)
+    return new_state
+
+ROW_MASK = (1 << BASE_WIDTH) - 1
+
+# exec_display, with the pixels past the right edge drawn at the left and
+# the rows past the bottom at the top
+def exec_display_wrap(state, instruction):
+    new_state = state
+    (_, rx, ry, h) = instruction
+    x = reg_value(new_state, rx) & 63
+    y = reg_value(new_state, ry) & 31
+
+    set_vf = 0
+    dirty  = 0
+
+    display = list(new_state.display)
+    index   = new_state.index
+    memory  = new_state.memory
+
+    for i in range(h):
+        sprite = memory[index + i] << 56
+        if sprite == 0:
+            continue
+        sprite = (sprite >> x | sprite << (64 - x)) & ROW_MASK
+        row_y = (y + i) & 31
+        row = display[row_y]
+        if row & sprite:
+            set_vf = 1
+        display[row_y] = row ^ sprite
+        dirty |= 1 << row_y
+
+    if dirty:
+        new_state.display = tuple(display)
+        new_state.dirty |= dirty
+    new_state = set_reg(new_state, 0xF, set_vf)
+    return new_state
+
+# Indexed by the op constants above, with chippy's quirks
+HANDLERS = (
+    exec_nop,
+    exec_clear_screen,
+    exec_return,
+    exec_jump,
+    exec_call,
+    exec_skip_cond_eq,
+    exec_skip_cond_neq,
+    exec_skip_cond_reg_eq,
+    exec_skip_cond_reg_neq,
+    exec_set,
+    exec_add,
+    exec_set_r,
+    exec_bin_or,
+    exec_bin_and,
+    exec_bin_xor,
+    exec_add_r,
+    exec_sub12,
+    exec_sub21,
+    exec_shift_l,
+    exec_shift_r,
+    exec_set_index,
+    exec_jump_offset,
+    exec_random,
+    exec_display,
+    exec_skip_if_pressed,
+    exec_skip_if_not_pressed,
+    exec_reg_from_delay_timer,
+    exec_delay_timer_from_reg,
+    exec_sound_timer_from_reg,
+    exec_add_to_index,
+    exec_get_pressed_value,
+    exec_font_character,
+    exec_hex_to_decimal_to_index,
+    exec_store_regs,
+    exec_load_regs,
+)
+
+assert len(OP_NAMES) == len(HANDLERS) == LoadRegs + 1
+
+QUIRK_HANDLERS = {DEFAULT_QUIRKS: HANDLERS} # quirks -> handlers, built once per profile
+
+def quirk_handlers(quirks):
+    handlers = QUIRK_HANDLERS.get(quirks)
+    if handlers is not None:
+        return handlers
+    table = list(HANDLERS)
+    if quirks.vf_flags:
+        table[AddR]  = exec_add_r_carry
+        table[Sub12] = exec_sub12_borrow
+        table[Sub21] = exec_sub21_borrow
+    if quirks.logic_vf_reset:
+        for op in (BinOr, BinAnd, BinXor):
+            table[op] = with_vf_reset(table[op])
+    if (quirks.swap_shifts, quirks.vf_flags, quirks.shift_vy) != (True, False, False):
+        (source, carry) = (2 if quirks.shift_vy else 1, int(quirks.vf_flags))
+        table[ShiftL] = make_shift(quirks.swap_shifts, source, carry)
+        table[ShiftR] = make_shift(not quirks.swap_shifts, source, carry)
+    if quirks.index_increment != 'none':
+        extra = int(quirks.index_increment == 'x+1')
+        table[StoreRegs] = with_index_increment(exec_store_regs, extra)
+        table[LoadRegs]  = with_index_increment(exec_load_regs, extra)
+    if quirks.jump_vx:
+        table[JumpOffset] = exec_jump_offset_vx
+    if quirks.sprite_wrap:
+        table[Display] = exec_display_wrap
+    handlers = tuple(table)
+    QUIRK_HANDLERS[quirks] = handlers
+    return handlers
+
+def exec_instruction(state, instruction):
+    return state.handlers[instruction[0]](state, instruction)
+
+def fetch_decode_exec(state):
+    new_state = state
+    pc = new_state.pc
+    page = new_state.memory.pages[pc >> PAGE_BITS]
+    # Pages are immutable, so an entry is stale exactly when its page has
+    # been replaced by a write. This also keeps branched states apart.
+    entry = new_state.decoded.get(pc)
+    if entry is None or entry[0] is not page:
+        (opcode, new_state) = fetch_opcode(new_state)
+        instruction         = decode_opcode(opcode)
+        entry               = (page, new_state.handlers[instruction[0]], instruction)
+        if pc & PAGE_MASK != PAGE_MASK: # does not straddle two pages
+            new_state.decoded[pc] = entry
+    else:
+        new_state.pc = pc + 2
+    (_, handler, instruction) = entry
+    return handler(new_state, instruction)
+
+def display_to_str(display):
+    return '\n'.join([''.join(['  ' if x == '0' else '##' for x in format(line, '064b')]) for line in display])
+
+def display_to_bytes(display): # 8 bytes per row, top row first
+    return b''.join([row.to_bytes(8, 'big') for row in display])
+
+def draw_to_terminal(state):
+    res = display_to_str(state.display)
+    print(res)
+    return res
+
+STATE_HASH_FIELDS = struct.Struct('>HIBB') # pc, index, delay timer, sound timer
+
+def state_hash(state):
+    h = hashlib.sha1()
+    # Nothing keeps I below 0x10000, so it takes 32 bits as in save states
+    h.update(STATE_HASH_FIELDS.pack(state.pc, state.index, state.delay_timer, state.sound_timer))
+    h.update(state.rng.to_bytes(4, 'big'))
+    h.update(bytes(state.regs))
+    h.update(bytes(state.memory))
+    h.update(display_to_bytes(state.display))
+    h.update(repr(stack_to_list(state.stack)).encode())
+    return h.hexdigest()
+
+# Tracing keeps the last TRACE_CAPACITY instructions in a ring of fixed-size
+# records: pc, opcode, a mask of the registers it changed and all 16
+# registers after it ran. Only the traced run loop touches it.
+TRACE_MAGIC    = b'C8TR'
+TRACE_HEADER   = struct.Struct('<4sII') # magic, record count, capacity
+TRACE_RECORD   = struct.Struct('<HHH16B')
+TRACE_CAPACITY = 4096
+
+class Trace:
+    __slots__ = ('buffer', 'capacity', 'count')
+
+    def __init__(self, capacity=TRACE_CAPACITY):
+        self.buffer   = bytearray(capacity * TRACE_RECORD.size)
+        self.capacity = capacity
+        self.count    = 0 # records written so far, the ring keeps the last ones
+
+def traced_fetch_decode_exec(state, trace):
+    pc     = state.pc
+    opcode = state.memory[pc] << 8 | state.memory[pc + 1]
+    before = state.regs[:]
+    # Written before running, so a dump after a failed assertion ends with
+    # the instruction that failed
+    offset = (trace.count % trace.capacity) * TRACE_RECORD.size
+    TRACE_RECORD.pack_into(trace.buffer, offset, pc, opcode, 0, *before)
+    trace.count += 1
+    new_state = fetch_decode_exec(state)
+    after  = new_state.regs
+    changed = 0
+    for i in range(16):
+        if before[i] != after[i]:
+            changed |= 1 << i
+    TRACE_RECORD.pack_into(trace.buffer, offset, pc, opcode, changed, *after)
+    return new_state
+
+def trace_records(trace): # oldest first
+    size  = TRACE_RECORD.size
+    count = min(trace.count, trace.capacity)
+    start = trace.count - count
+    return [TRACE_RECORD.unpack_from(trace.buffer, ((start + i) % trace.capacity) * size)
+            for i in range(count)]
+
+def dump_trace(trace, fname):
+    records = trace_records(trace)
+    with open(fname, "wb") as f:
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, len(records), trace.capacity))
+        for record in records:
+            f.write(TRACE_RECORD.pack(*record))
+
+def read_trace(fname):
+    with open(fname, "rb") as f:
+        data = f.read()
+    (magic, count, _) = TRACE_HEADER.unpack_from(data)
+    assert magic == TRACE_MAGIC
+    return [TRACE_RECORD.unpack_from(data, TRACE_HEADER.size + i * TRACE_RECORD.size)
+            for i in range(count)]
+
+def trace_record_to_str(record):
+    (pc, opcode, changed, *regs) = record
+    try:
+        instruction = instruction_to_str(decode_opcode(opcode))
+    except AssertionError:
+        instruction = "Unknown"
+    writes = ' '.join(["V{:X}={:02X}".format(i, regs[i]) for i in range(16) if (changed >> i) & 1])
+    return "{:03X}: {:04X} {} {}".format(pc, opcode, instruction, writes).rstrip()
+
+def waiting_for_key(state): # stopped at GetPressedValue with no key held
+    pc = state.pc
+    return state.keys == 0 and (state.memory[pc] << 8 | state.memory[pc + 1]) & 0xF0FF == 0xF00A
+
+# In an idle loop that neither reads a running delay timer nor sets a timer,
+# frames change nothing but the timers until the keys change
+def idle_for_good(state):
+    return state.idle is not None and not state.idle[1]
+
+def waits_for_timer(state): # in an idle loop that uses the timers, see run_timer_wait
+    return state.idle is not None and state.idle[1]
+
+# A loop waiting for the delay timer changes nothing but the timer and the
+# registers it reads it into. If it runs nothing but TIMER_WAIT_OPS, reads
+# the timer only into registers nothing else writes and compares them with
+# no value they can reach, it does the same with the timer and those
+# registers n lower, and they come out n lower too. So once some frames
+# bring the machine back to the pc they started at with only those lowered,
+# the frames after do the same, until a value the registers are compared
+# with, or zero, comes in reach.
+TIMER_WAIT_OPS = {
+    Nop, Jump, Set, SkipCondEq, SkipCondNEq, SkipCondRegEq, SkipCondRegNEq, RegFromDelayTimer,
+}
+
+def timer_regs(instructions):
+    return {instruction[1] for instruction in instructions if instruction[0] == RegFromDelayTimer}
+
+# How many frames from `state` on a wait running `instructions` is the same
+# but lower, at most `max_frames`, see above
+def timer_wait_frames(state, instructions, max_frames):
+    regs = timer_regs(instructions)
+    consts = {}
+    for instruction in instructions:
+        if instruction[0] == Set:
+            consts.setdefault(instruction[1], set()).add(instruction[2])
+    if (not regs or regs & set(consts)
+        or any(instruction[0] not in TIMER_WAIT_OPS for instruction in instructions)):
+        return 0
+    compared = set()
+    for instruction in instructions:
+        if instruction[0] in (SkipCondEq, SkipCondNEq) and instruction[1] in regs:
+            compared.add(instruction[2])
+        elif instruction[0] in (SkipCondRegEq, SkipCondRegNEq):
+            (_, x, y) = instruction
+            if (x in regs) != (y in regs):
+                other = y if x in regs else x
+                compared |= consts.get(other, set()) | {state.regs[other]}
+    values = [state.regs[reg] for reg in regs]
+    highest = max(values + [state.delay_timer])
+    reached = max([value for value in compared if value <= highest], default=-1)
+    frames = min(state.delay_timer - max(reached, 0), min(values) - reached - 1)
+    return frames if max_frames is None else min(frames, max_frames)
+
+# run_frame on the interpreter, with every opcode it ran
+def step_frames(state, instructions_per_frame, frames):
+    new_state = state.copy()
+    opcodes = set()
+    for _ in range(frames):
+        try:
+            for _ in range(instructions_per_frame):
+                pc = new_state.pc
+                opcodes.add(new_state.memory[pc] << 8 | new_state.memory[pc + 1])
+                new_state = fetch_decode_exec(new_state)
+        except WaitingForKey:
+            pass
+        new_state.cycles += instructions_per_frame
+        new_state = tick_timers(new_state)
+    return (new_state, opcodes)
+
+def lowered_by(old_state, new_state, regs, n): # new_state is old_state with the timer and `regs` n lower
+    return ((new_state.pc, new_state.index, new_state.stack, new_state.display,
+             new_state.memory.pages, new_state.rng, new_state.delay_timer)
+            == (old_state.pc, old_state.index, old_state.stack, old_state.display,
+                old_state.memory.pages, old_state.rng, old_state.delay_timer - n)
+            and all(new_state.regs[reg] == old_state.regs[reg] - (n if reg in regs else 0)
+                    for reg in range(16)))
+
+# Runs the frames of a wait for the delay timer in state.idle that can be
+# jumped, at most `max_frames`: as many as it takes the loop to come back to
+# the same place at the start of a frame, to see that they only lowered the
+# timer and the registers read from it, then the rest at once.
+# (state, frames run, whether the rest were jumped)
+def run_timer_wait(state, instructions_per_frame, max_frames):
+    loop = state.idle[0]
+    period = len(loop) // math.gcd(len(loop), instructions_per_frame)
+    instructions = [decode_opcode(state.memory[pc] << 8 | state.memory[pc + 1]) for pc in loop]
+    if timer_wait_frames(state, instructions, max_frames) < 2 * period:
+        return (state, 0, False)
+    (new_state, opcodes) = step_frames(state, instructions_per_frame, period)
+    instructions = [decode_opcode(opcode) for opcode in opcodes]
+    frames = timer_wait_frames(state, instructions, max_frames)
+    frames -= frames % period
+    regs = timer_regs(instructions)
+    if frames < 2 * period or not lowered_by(state, new_state, regs, period):
+        return (new_state, period, False)
+    n = frames - period
+    new_state.delay_timer -= n
+    new_state.sound_timer = max(new_state.sound_timer - n, 0)
+    for reg in regs:
+        new_state.regs[reg] -= n
+    new_state.cycles += n * instructions_per_frame
+    return (new_state, frames, True)
+
+def tick_timers(state):
+    new_state = state
+    if new_state.delay_timer > 0:
+        new_state.delay_timer -= 1
+    if new_state.sound_timer > 0:
+        new_state.sound_timer -= 1
+    return new_state
+
+# A runner is any function (state, count) -> state that executes exactly
+# `count` instructions. The loops below take one, so tracing or another
+# engine is chosen once per run and never checked per instruction.
+def run_instructions(state, count):
+    new_state = state.copy()
+    try:
+        for _ in range(count):
+            new_state = fetch_decode_exec(new_state)
+    except WaitingForKey:
+        pass
+    new_state.cycles += count
+    return new_state
+
+def traced_runner(trace):
+    def run_traced(state, count):
+        new_state = state.copy()
+        try:
+            for _ in range(count):
+                new_state = traced_fetch_decode_exec(new_state, trace)
+        except WaitingForKey:
+            pass
+        new_state.cycles += count
+        return new_state
+    return run_traced
+
+# One frame is 1/60 of a second of emulated time, however long it takes
+def run_frame(state, instructions_per_frame, run=run_instructions):
+    return tick_timers(run(state, instructions_per_frame))
+
+# Runs whole frames until either budget is used up. A cycle budget that
+# ends inside a frame runs the rest of the instructions without a timer tick.
+# Keys do not change here, so once the machine is idle for good all the
+# frames up to the budget are run as one and the timers counted down after,
+# and a wait for the delay timer is jumped to where it can end.
+def run_for(state, instructions_per_frame, max_cycles=None, max_frames=None, run=run_instructions):
+    new_state = state
+    frames = 0
+    given_up = None # the last loop whose wait could not be jumped
+    while new_state.is_running:
+        if max_frames is not None and frames >= max_frames:
+            break
+        if max_cycles is not None:
+            left = max_cycles - new_state.cycles
+            if left < instructions_per_frame:
+                if left > 0:
+                    new_state = run(new_state, left)
+                break
+        n = max_frames - frames if max_frames is not None else None
+        if max_cycles is not None:
+            by_cycles = (max_cycles - new_state.cycles) // instructions_per_frame
+            n = by_cycles if n is None else min(n, by_cycles)
+        if idle_for_good(new_state):
+            if n is not None and n > 1:
+                new_state = run(new_state, n * instructions_per_frame)
+                new_state.delay_timer = max(new_state.delay_timer - n, 0)
+                new_state.sound_timer = max(new_state.sound_timer - n, 0)
+                frames += n
+                continue
+        elif waits_for_timer(new_state) and new_state.idle[0] != given_up:
+            (new_state, done, jumped) = run_timer_wait(new_state, instructions_per_frame, n)
+            if done > 0:
+                if not jumped:
+                    given_up = new_state.idle[0]
+                frames += done
+                continue
+        new_state = run_frame(new_state, instructions_per_frame, run)
+        frames += 1
+    return new_state
+
+# An input script is a list of (cycle, keys) events sorted by cycle: from
+# that instruction on, `keys` is the mask of pressed keys. In a file every
+# line is "<cycle> <keys in hex>", # starts a comment.
+def read_input_script(fname):
+    events = []
+    with open(fname) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line == '':
+                continue
+            (cycle, keys) = line.split()
+            events.append((int(cycle), int(keys, 16)))
+    return sorted(events)
+
+# Like run_for with a cycle budget, but frames are split wherever an event
+# of the script falls, so keys change at exactly the given instruction
+def run_script(state, instructions_per_frame, events, max_cycles, run=run_instructions):
+    new_state = state.copy()
+    i = 0
+    while new_state.is_running and new_state.cycles < max_cycles:
+        left = instructions_per_frame
+        while left > 0 and new_state.cycles < max_cycles:
+            while i < len(events) and events[i][0] <= new_state.cycles:
+                new_state.keys = events[i][1]
+                i += 1
+            count = min(left, max_cycles - new_state.cycles)
+            if i < len(events):
+                count = min(count, events[i][0] - new_state.cycles)
+            new_state = run(new_state, count)
+            left -= count
+        if left == 0:
+            new_state = tick_timers(new_state)
+    return new_state
+
+def load_rom_data(state, rom_data):
+    new_state = state
+    assert len(rom_data) <= _4KB - 0x200
+    rom = memory_from_bytes(bytes(rom_data) + bytes(_4KB - (len(rom_data) + 0x200)))
+    new_state.memory = Memory(new_state.memory.pages[:0x200 >> PAGE_BITS] + rom.pages)
+    new_state.decoded = {}
+    new_state.blocks = {}
+    return new_state
+
+def load_rom(state, fname):
+    with open(fname, "rb") as f:
+        return load_rom_data(state, f.read())
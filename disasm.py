@@ -0,0 +1,235 @@
+# Finds the code in a ROM without running it. Starting from 0x200 it follows
+# every way the pc can go: jumps, calls and the returns after them, both ways
+# out of a skip. Everything it reaches is code, split into basic blocks with
+# the edges between them; the other bytes are data, and the ones an
+# instruction points the index at are most likely sprites.
+#
+# Where the pc goes after a JumpOffset depends on a register, so those are
+# only listed, and code reached through them or written at run time is missed.
+#
+# The analysis is plain JSON and is cached under the SHA-1 of the ROM, so
+# asking again for the same ROM does not redo it.
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+from chip8 import *
+
+ANALYSIS_VERSION = 1
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chippy", "disasm")
+
+ROM_START = 0x200
+
+SKIPS = {SkipCondEq, SkipCondNEq, SkipCondRegEq, SkipCondRegNEq, SkipIfPressed, SkipIfNotPressed}
+
+# The pc never just goes on to the next instruction after these
+BLOCK_ENDS = {Jump, Call, Return, JumpOffset} | SKIPS
+
+def rom_hash(rom_data):
+    return hashlib.sha1(rom_data).hexdigest()
+
+def decode_at(rom_data, addr): # the instruction at addr, None if it is not a valid one
+    offset = addr - ROM_START
+    if offset < 0 or offset + 2 > len(rom_data):
+        return None
+    opcode = rom_data[offset] << 8 | rom_data[offset + 1]
+    try:
+        return (opcode, decode_opcode(opcode))
+    except AssertionError:
+        return None
+
+def successors(addr, instruction): # where the pc can go next, calls not included
+    op = instruction[0]
+    if op == Jump:
+        return [instruction[1]]
+    if op in (Return, JumpOffset):
+        return []
+    if op in SKIPS:
+        return [addr + 2, addr + 4]
+    return [addr + 2]
+
+# Recursive descent from ROM_START. Returns {addr: (opcode, instruction)},
+# the call targets and the addresses the pc can reach without a valid
+# instruction there, from the ROM running off its end or into bad opcodes.
+def trace_code(rom_data):
+    code = {}
+    calls = set()
+    invalid = set()
+    todo = [ROM_START]
+    while todo:
+        addr = todo.pop()
+        if addr in code or addr in invalid:
+            continue
+        decoded = decode_at(rom_data, addr)
+        if decoded is None:
+            invalid.add(addr)
+            continue
+        code[addr] = decoded
+        instruction = decoded[1]
+        if instruction[0] == Call:
+            calls.add(instruction[1])
+            todo.append(instruction[1])
+        todo += successors(addr, instruction)
+    return (code, calls, invalid)
+
+# A block starts at ROM_START, at every target of a jump, call or skip and
+# after every instruction that ends one, and runs up to the next start or
+# the end of the code it belongs to
+def basic_blocks(code, calls):
+    starts = {ROM_START} | calls
+    for addr, (_, instruction) in code.items():
+        if instruction[0] in BLOCK_ENDS:
+            starts.update(successors(addr, instruction))
+            if instruction[0] == Call:
+                starts.add(addr + 2)
+
+    blocks = []
+    for start in sorted(starts & code.keys()):
+        addr = start
+        while True:
+            instruction = code[addr][1]
+            next_addrs = successors(addr, instruction)
+            if instruction[0] in BLOCK_ENDS or next_addrs[0] in starts or next_addrs[0] not in code:
+                break
+            addr = next_addrs[0]
+        blocks.append({
+            'start': start,
+            'end': addr + 2,
+            'exit': OP_NAMES[instruction[0]],
+            'successors': next_addrs,
+            'call': instruction[1] if instruction[0] == Call else None,
+        })
+    return blocks
+
+def data_ranges(rom_data, code): # [(start, end)] of the bytes no instruction covers
+    covered = set()
+    for addr in code:
+        covered.update((addr, addr + 1))
+    ranges = []
+    for addr in range(ROM_START, ROM_START + len(rom_data)):
+        if addr in covered:
+            continue
+        if ranges and ranges[-1][1] == addr:
+            ranges[-1] = (ranges[-1][0], addr + 1)
+        else:
+            ranges.append((addr, addr + 1))
+    return ranges
+
+def analyse(rom_data):
+    (code, calls, invalid) = trace_code(rom_data)
+    data = data_ranges(rom_data, code)
+    data_bytes = {addr for start, end in data for addr in range(start, end)}
+    return {
+        'version': ANALYSIS_VERSION,
+        'sha1': rom_hash(rom_data),
+        'size': len(rom_data),
+        'code': [[addr, code[addr][0]] for addr in sorted(code)],
+        'blocks': basic_blocks(code, calls),
+        'calls': sorted(calls),
+        'indirect_jumps': sorted(addr for addr, (_, instruction) in code.items()
+                                 if instruction[0] == JumpOffset),
+        'invalid_targets': sorted(invalid),
+        'data': [list(r) for r in data],
+        'sprites': sorted({instruction[1] for _, instruction in code.values()
+                           if instruction[0] == SetIndex and instruction[1] in data_bytes}),
+    }
+
+def cache_path(cache_dir, rom_data):
+    return os.path.join(cache_dir, rom_hash(rom_data) + ".json")
+
+def load_analysis(rom_data, cache_dir=CACHE_DIR): # analyse(), from the cache if it is there
+    path = cache_path(cache_dir, rom_data) if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            analysis = json.load(f)
+        if analysis.get('version') == ANALYSIS_VERSION:
+            return analysis
+    analysis = analyse(rom_data)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # A file of its own to write to, since other processes may be writing
+        # the same analysis, and never half a file for the next reader
+        (fd, tmp) = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(analysis, f)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return analysis
+
+def sprite_row_to_str(byte):
+    return ''.join('#' if (byte >> (7 - x)) & 1 else '.' for x in range(8))
+
+def analysis_to_str(analysis, rom_data):
+    labels = {}
+    for block in analysis['blocks']:
+        labels[block['start']] = "block_{:03X}".format(block['start'])
+    for addr in analysis['calls']:
+        labels[addr] = "sub_{:03X}".format(addr)
+    labels[ROM_START] = "start"
+    indirect = set(analysis['indirect_jumps'])
+    sprites = set(analysis['sprites'])
+
+    # Code and data, in address order
+    lines = []
+    items = [(addr, 'code', opcode) for addr, opcode in analysis['code']]
+    items += [(start, 'data', end) for start, end in analysis['data']]
+    for addr, kind, value in sorted(items):
+        if kind == 'code':
+            if addr in labels:
+                lines += ["", labels[addr] + ":"]
+            comment = "  ; indirect, depends on a register" if addr in indirect else ""
+            lines.append("{:03X}  {:04X}  {}{}".format(
+                addr, value, instruction_to_str(decode_opcode(value)), comment))
+            continue
+        lines.append("")
+        for row in range(addr, value):
+            byte = rom_data[row - ROM_START]
+            comment = "  ; sprite" if row in sprites else ""
+            lines.append("{:03X}  {:02X}    {}{}".format(row, byte, sprite_row_to_str(byte), comment))
+
+    lines += ["", "; {} instructions in {} blocks, {} subroutines, {} data bytes".format(
+        len(analysis['code']), len(analysis['blocks']), len(analysis['calls']),
+        sum(end - start for start, end in analysis['data']))]
+    for addr in analysis['indirect_jumps']:
+        lines.append("; indirect jump at {:03X}, code it reaches is not listed".format(addr))
+    for addr in analysis['invalid_targets']:
+        lines.append("; no valid instruction at {:03X}, but the pc can get there".format(addr))
+    return '\n'.join(lines).lstrip('\n')
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Chip8 disassembler")
+    parser.add_argument("rom")
+    parser.add_argument("--json", action="store_true",
+                        help="print the analysis as JSON instead of a listing")
+    parser.add_argument("--output", metavar="PATH",
+                        help="write to PATH instead of stdout")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, metavar="DIR",
+                        help="where analyses are kept, by ROM hash (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always analyse the ROM and do not keep the result")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    with open(args.rom, "rb") as f:
+        rom_data = f.read()
+    analysis = load_analysis(rom_data, None if args.no_cache else args.cache_dir)
+
+    if args.json:
+        text = json.dumps(analysis, indent=1)
+    else:
+        text = analysis_to_str(analysis, rom_data)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Shares every frame with other processes through a file mapped into memory:
+# the display, the registers, and counters of frames and instructions. Put
+# the file under /dev/shm and it never touches the disk.
+#
+# The writer packs each frame straight into the mapping, and readers map the
+# same file and unpack it from there, so nothing is copied on the way or
+# serialised. A sequence number guards against reading half a frame: it is
+# odd while the writer is in the middle of one, and a reader that sees it
+# odd, or changed after reading, reads again. A writer that stays in the
+# middle of a frame for READ_TIMEOUT has died there, and the reader gives up.
+import sys
+import time
+import mmap
+import struct
+import argparse
+from chip8 import *
+
+EXPORT_MAGIC   = b'C8FX'
+EXPORT_VERSION = 3
+
+EXPORT_HEADER = struct.Struct('<4sB3x') # magic, version
+EXPORT_SEQ    = struct.Struct('<Q') # two per frame, so 32 bits would run out in a long run
+SEQ_OFFSET    = 8
+
+# frame, cycles, pc, index, delay timer, sound timer, keys, regs
+EXPORT_STATE   = struct.Struct('<QQHIBBH16s')
+STATE_OFFSET   = 16
+EXPORT_DISPLAY = struct.Struct('<32Q') # rows, top first, leftmost pixel in the top bit
+DISPLAY_OFFSET = STATE_OFFSET + EXPORT_STATE.size
+EXPORT_SIZE    = DISPLAY_OFFSET + EXPORT_DISPLAY.size
+
+READ_RETRY   = 0.0005 # seconds between two looks at a frame being written
+READ_TIMEOUT = 1.0 # seconds
+
+class FrameExport:
+    __slots__ = ('file', 'buffer', 'seq', 'frame', 'last')
+
+    def __init__(self, file, buffer):
+        self.file   = file
+        self.buffer = buffer # the mapping
+        self.seq    = 0
+        self.frame  = 0
+        self.last   = None # display exported last, not written again while it stays
+
+def open_export(path):
+    f = open(path, "w+b")
+    f.truncate(EXPORT_SIZE)
+    buffer = mmap.mmap(f.fileno(), EXPORT_SIZE)
+    EXPORT_HEADER.pack_into(buffer, 0, EXPORT_MAGIC, EXPORT_VERSION)
+    return FrameExport(f, buffer)
+
+def export_frame(export, state):
+    buffer = export.buffer
+    export.seq += 1
+    EXPORT_SEQ.pack_into(buffer, SEQ_OFFSET, export.seq)
+    export.frame += 1
+    EXPORT_STATE.pack_into(buffer, STATE_OFFSET, export.frame, state.cycles, state.pc, state.index,
+                           state.delay_timer, state.sound_timer, state.keys, bytes(state.regs))
+    if state.display is not export.last:
+        EXPORT_DISPLAY.pack_into(buffer, DISPLAY_OFFSET, *state.display)
+        export.last = state.display
+    export.seq += 1
+    EXPORT_SEQ.pack_into(buffer, SEQ_OFFSET, export.seq)
+
+def close_export(export): # the file stays, with the last frame in it
+    export.buffer.close()
+    export.file.close()
+
+def exported(export, frame): # frame, a run_frame, exporting every frame it runs
+    def run_exported(*args):
+        new_state = frame(*args)
+        export_frame(export, new_state)
+        return new_state
+    return run_exported
+
+class ExportedFrame:
+    __slots__ = ('frame', 'cycles', 'pc', 'index', 'delay_timer', 'sound_timer', 'keys',
+                 'regs', 'display')
+
+def open_reader(path):
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), EXPORT_SIZE, access=mmap.ACCESS_READ)
+    (magic, version) = EXPORT_HEADER.unpack_from(buffer)
+    assert magic == EXPORT_MAGIC and version == EXPORT_VERSION
+    return buffer
+
+# The newest frame in `buffer`, None before the first one. Raises
+# TimeoutError if the writer stopped in the middle of a frame.
+def read_frame(buffer, timeout=READ_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while True:
+        (seq, ) = EXPORT_SEQ.unpack_from(buffer, SEQ_OFFSET)
+        if seq & 1: # the writer is in the middle of a frame
+            if time.monotonic() > deadline:
+                raise TimeoutError("the writer stopped in the middle of frame {}".format(seq // 2 + 1))
+            time.sleep(READ_RETRY)
+            continue
+        state = EXPORT_STATE.unpack_from(buffer, STATE_OFFSET)
+        display = EXPORT_DISPLAY.unpack_from(buffer, DISPLAY_OFFSET)
+        if EXPORT_SEQ.unpack_from(buffer, SEQ_OFFSET)[0] == seq:
+            break
+    if seq == 0:
+        return None
+    res = ExportedFrame()
+    (res.frame, res.cycles, res.pc, res.index, res.delay_timer, res.sound_timer,
+     res.keys, res.regs) = state
+    res.display = display
+    return res
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Watch the frames a Chip8 emulator exports")
+    parser.add_argument("path", help="the file given to main.py --export")
+    parser.add_argument("--show", action="store_true",
+                        help="draw the display of every frame too")
+    parser.add_argument("--interval", type=float, default=FRAME_TIME,
+                        help="seconds between two looks (default: %(default).4f)")
+    return parser.parse_args(argv)
+
+# Follows an export from the outside: prints every frame it sees, which is
+# not every frame when the emulator runs faster than this looks
+def main():
+    args = parse_args(sys.argv[1:])
+    buffer = open_reader(args.path)
+    last = None
+    try:
+        while True:
+            frame = read_frame(buffer)
+            if frame is not None and frame.frame != last:
+                last = frame.frame
+                print("frame {} cycles {} pc {:03X} index {:03X} regs {}".format(
+                    frame.frame, frame.cycles, frame.pc, frame.index, frame.regs.hex()))
+                if args.show:
+                    print(display_to_str(frame.display))
+                sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    except TimeoutError as e:
+        sys.exit("export.py: {}".format(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from chip8 import *
+from main import ENGINES
+from idle import idle_runner
+from romcache import CACHE_DIR, load_rom_cached
+
+ROM_EXTENSIONS = ('.ch8', '.c8')
+SCRIPT_EXTENSION = '.keys'
+QUIRKS_EXTENSION = '.quirks'
+
+def find_roms(paths):
+    roms = []
+    for path in paths:
+        if not os.path.isdir(path):
+            roms.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            roms += [os.path.join(root, f) for f in files if f.lower().endswith(ROM_EXTENSIONS)]
+    return sorted(roms)
+
+def find_scripts(rom): # pong.ch8 is run with pong.keys and every pong.*.keys
+    (stem, _) = os.path.splitext(rom)
+    directory = os.path.dirname(rom) or '.'
+    name = os.path.basename(stem)
+    return sorted([os.path.join(directory, f) for f in os.listdir(directory)
+                   if f == name + SCRIPT_EXTENSION
+                   or (f.startswith(name + '.') and f.endswith(SCRIPT_EXTENSION))])
+
+def find_quirks(rom, default): # pong.quirks holds the quirk profile pong.ch8 runs with
+    path = os.path.splitext(rom)[0] + QUIRKS_EXTENSION
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return f.read().strip()
+
+# One job per ROM and input script, or one job without input for a ROM that
+# has no scripts. Biggest ROMs first, so a long job does not start last and
+# leave the other workers idle at the end.
+def make_jobs(roms, cycles, ipf, engine, seed, quirks, rom_cache):
+    jobs = []
+    for rom in roms:
+        for script in find_scripts(rom) or [None]:
+            jobs.append({'rom': rom, 'script': script, 'cycles': cycles, 'ipf': ipf,
+                         'engine': engine, 'seed': seed, 'quirks': find_quirks(rom, quirks),
+                         'rom_cache': rom_cache})
+    jobs.sort(key=lambda job: os.path.getsize(job['rom']), reverse=True)
+    return jobs
+
+def display_hash(display):
+    return hashlib.sha1(display_to_bytes(display)).hexdigest()
+
+def run_job(job):
+    result = {'rom': job['rom'], 'script': job['script'], 'quirks': job['quirks']}
+    start = time.perf_counter()
+    state = None
+    hashes = (None, None) # display, state
+    try:
+        # Every worker makes the image of a ROM once, however many of its jobs run it
+        state = load_rom_cached(default_state(job['seed'], parse_quirks(job['quirks'])),
+                                job['rom'], job['rom_cache'])
+        events = read_input_script(job['script']) if job['script'] is not None else []
+        run = idle_runner(ENGINES[job['engine']])
+        # A frame at a time, so a failure still reports how far the ROM got
+        while state.is_running and state.cycles < job['cycles']:
+            budget = min(job['cycles'], state.cycles + job['ipf'])
+            state = run_script(state, job['ipf'], events, budget, run)
+            # run_script stops before an event at the cycle it stops at, so that one stays
+            events = [e for e in events if e[0] >= state.cycles]
+        # Hashed in here too, so a state that fails to hash fails only this job
+        hashes = (display_hash(state.display), state_hash(state))
+        result['error'] = None
+    except Exception as e:
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+    seconds = time.perf_counter() - start
+
+    cycles = state.cycles if state is not None else 0
+    result['cycles']       = cycles
+    result['seconds']      = round(seconds, 6)
+    result['ips']          = int(cycles / seconds) if seconds > 0 else 0
+    (result['display_hash'], result['state_hash']) = hashes
+    return result
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run a corpus of Chip8 ROMs on all cores")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="ROM files, or directories searched for *.ch8 and *.c8")
+    parser.add_argument("--cycles", type=int, default=1000000,
+                        help="instructions to run per job (default: %(default)s)")
+    parser.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME,
+                        help="instructions per 1/60 s frame (default: %(default)s)")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="blocks",
+                        help="engine every job runs on (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="seed of every machine's random number generator (default: %(default)s)")
+    parser.add_argument("--quirks", default="chippy", metavar="PROFILE",
+                        help="quirk profile of the ROMs without a .quirks file next to them, "
+                             "see main.py --help (default: %(default)s)")
+    parser.add_argument("--output", metavar="PATH",
+                        help="write the results here instead of stdout")
+    parser.add_argument("--rom-cache", default=CACHE_DIR, metavar="DIR",
+                        help="where ROMs are kept ready to run, by hash, see romcache.py (default: %(default)s)")
+    parser.add_argument("--no-rom-cache", action="store_true",
+                        help="do not keep images of the ROMs on disk")
+    args = parser.parse_args(argv)
+    try:
+        parse_quirks(args.quirks)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    jobs = make_jobs(find_roms(args.paths), args.cycles, args.ipf, args.engine, args.seed, args.quirks,
+                     None if args.no_rom_cache else args.rom_cache)
+
+    out = open(args.output, "w") if args.output is not None else sys.stdout
+    failed = 0
+    start = time.perf_counter()
+    # Results are written as each job finishes, one JSON object per line
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for future in as_completed([pool.submit(run_job, job) for job in jobs]):
+            result = future.result()
+            if result['error'] is not None:
+                failed += 1
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    if out is not sys.stdout:
+        out.close()
+
+    print("{} jobs, {} failed, {:.1f} s".format(len(jobs), failed, time.perf_counter() - start),
+          file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
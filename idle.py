@@ -0,0 +1,80 @@
+# Skips idle loops: code that runs in circles without changing anything,
+# like waiting for the delay timer or spinning on a jump to itself.
+#
+# The idle runner steps the first few instructions of every run itself. If
+# the pc comes back to where the run started and the whole machine is the
+# same as it was the time around before, the machine is in a loop that
+# changes nothing, and since keys and timers do not change inside a run,
+# every further time around the loop is the same: those are counted as run
+# without running them. Only the instructions left over after the last whole
+# loop are run, so the result is exactly that of running every instruction.
+#
+# Busy code never passes the probe, so after every miss the runner waits for
+# twice as many runs as before, up to MAX_IDLE_BACKOFF, before probing again.
+#
+# The runner leaves (addresses of the loop, whether it uses the timers) in
+# state.idle, so that run_for can also jump over whole frames while nothing
+# but the timers would change, or only the timer and what the loop reads
+# it into.
+from chip8 import *
+
+MAX_IDLE_LOOP    = 16 # instructions
+MAX_IDLE_BACKOFF = 8 # runs
+
+def machine_key(state): # everything an instruction can read or change
+    return (state.pc, state.index, state.regs[:], state.stack, state.display,
+            state.memory.pages, state.rng, state.delay_timer, state.sound_timer)
+
+# Whether frames change what the loop does: it reads the delay timer while
+# it runs, or sets a timer that would otherwise count down
+def uses_timers(state, pcs):
+    ops = {(state.memory[pc] << 8 | state.memory[pc + 1]) & 0xF0FF for pc in pcs}
+    return (state.delay_timer > 0 and 0xF007 in ops) or 0xF015 in ops or 0xF018 in ops
+
+def idle_runner(run):
+    backoff = 0 # runs left before the next probe
+    wait = 1 # runs to wait after the next miss
+    def run_idle(state, count):
+        nonlocal backoff, wait
+        if backoff > 0:
+            backoff -= 1
+            new_state = run(state, count)
+            new_state.idle = None
+            return new_state
+        new_state = state.copy()
+        new_state.idle = None
+        key = machine_key(new_state)
+        limit = min(MAX_IDLE_LOOP, count // 2) # a loop has to fit at least twice
+        pcs = []
+        try:
+            # Once around the loop, and if the machine changed on the way, once
+            # more: the first time around can still pick up what changed since
+            # the last run, like a timer that ticked and is read into a register
+            for _ in range(2):
+                loop = []
+                while len(loop) < limit:
+                    loop.append(new_state.pc)
+                    new_state = fetch_decode_exec(new_state)
+                    if new_state.pc == key[0]:
+                        break
+                pcs += loop
+                if not loop or new_state.pc != key[0]:
+                    break
+                last = key
+                key = machine_key(new_state)
+                if key == last:
+                    for _ in range((count - len(pcs)) % len(loop)):
+                        new_state = fetch_decode_exec(new_state)
+                    new_state.idle = (tuple(loop), uses_timers(new_state, loop))
+                    new_state.cycles += count
+                    wait = 1
+                    return new_state
+        except WaitingForKey:
+            new_state.cycles += count
+            return new_state
+        backoff = wait
+        wait = min(wait * 2, MAX_IDLE_BACKOFF)
+        new_state = run(new_state, count - len(pcs))
+        new_state.cycles += len(pcs)
+        return new_state
+    return run_idle
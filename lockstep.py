@@ -0,0 +1,205 @@
+# Checks an engine against the interpreter. Both run the same ROMs with the
+# same input scripts, and every --interval frames their state hashes are
+# compared. The interpreter's state at the last check where they agreed is
+# kept as a save state; once they disagree, both are run again from it to
+# halfway points, bisecting down to the first instruction after which they
+# differ, which is reported with everything that differs after it.
+#
+# Comparing hashes only every so often keeps a check almost as fast as the
+# two engines themselves, and bisecting costs a few more runs of at most
+# one interval.
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from chip8 import *
+from blocks import run_blocks
+from idle import idle_runner
+from savestate import save_state, load_state
+from farm import find_roms, find_scripts, find_quirks
+
+REFERENCE = run_instructions
+
+def batch_runner(): # one lane of the NumPy engine, which needs numpy
+    from batch import batch_from_states, step_batch, lane_to_state, LANE_ERRORS
+    def run_batch_lane(state, count):
+        batch = batch_from_states([state])
+        for _ in range(count):
+            step_batch(batch)
+        assert batch.alive[0], LANE_ERRORS[batch.error[0]]
+        return lane_to_state(batch, 0)
+    return run_batch_lane
+
+# Engines that can be checked, each made fresh for every run
+CANDIDATES = {
+    'blocks':      lambda: run_blocks,
+    'idle':        lambda: idle_runner(run_instructions),
+    'idle-blocks': lambda: idle_runner(run_blocks),
+    'batch':       batch_runner,
+}
+
+# Up to `cycles`, -> (state, error, state hash). A failed run has no state,
+# only the error it failed with, and neither has a state that fails to hash.
+def run_checked(state, ipf, events, cycles, run):
+    try:
+        new_state = run_script(state, ipf, events, cycles, run)
+        return (new_state, None, state_hash(new_state))
+    except Exception as e:
+        return (None, "{}: {}".format(type(e).__name__, e), None)
+
+def rerun(snapshot, ipf, events, cycles, run): # run_checked from a save state
+    return run_checked(load_state(snapshot), ipf, events, cycles, run)
+
+def outcome(result): # what has to be equal: the hash, or that the run failed
+    (_, error, digest) = result
+    return digest if error is None else 'error'
+
+def state_diff(a, b): # ["what: a != b"] for everything state_hash covers
+    res = []
+    for name in ('pc', 'index', 'delay_timer', 'sound_timer', 'rng'):
+        if getattr(a, name) != getattr(b, name):
+            res.append("{}: 0x{:X} != 0x{:X}".format(name, getattr(a, name), getattr(b, name)))
+    for reg in range(16):
+        if a.regs[reg] != b.regs[reg]:
+            res.append("V{:X}: 0x{:02X} != 0x{:02X}".format(reg, a.regs[reg], b.regs[reg]))
+    if stack_to_list(a.stack) != stack_to_list(b.stack):
+        res.append("stack: {} != {}".format(stack_to_list(a.stack), stack_to_list(b.stack)))
+    (mem_a, mem_b) = (bytes(a.memory), bytes(b.memory))
+    for addr in range(len(mem_a)):
+        if mem_a[addr] != mem_b[addr]:
+            res.append("memory[0x{:03X}]: 0x{:02X} != 0x{:02X}".format(addr, mem_a[addr], mem_b[addr]))
+    for y in range(len(a.display)):
+        if a.display[y] != b.display[y]:
+            res.append("display row {}: {:016X} != {:016X}".format(y, a.display[y], b.display[y]))
+    return res
+
+def instruction_at(state):
+    opcode = state.memory[state.pc] << 8 | state.memory[state.pc + 1]
+    try:
+        return "{} {}".format(opcode_in_hex(opcode), instruction_to_str(decode_opcode(opcode)))
+    except AssertionError:
+        return "{} (unknown)".format(opcode_in_hex(opcode))
+
+# The runs from `snapshot` agree up to `lo` cycles and not up to `hi`: halve
+# the gap until the instruction run at cycle `lo` is the one that differs
+def bisect(snapshot, lo, hi, ipf, events, candidate):
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        ref  = rerun(snapshot, ipf, events, mid, REFERENCE)
+        cand = rerun(snapshot, ipf, events, mid, candidate())
+        if outcome(ref) == outcome(cand):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def divergence(snapshot, lo, hi, ipf, events, candidate):
+    ref  = rerun(snapshot, ipf, events, hi, REFERENCE)
+    cand = rerun(snapshot, ipf, events, hi, candidate())
+    if outcome(ref) == outcome(cand):
+        return {'cycle': None, 'details': [
+            "differed between cycles {} and {}, but not when run again from {}".format(lo, hi, lo)]}
+
+    cycle = bisect(snapshot, lo, hi, ipf, events, candidate)
+    (before, _, _) = rerun(snapshot, ipf, events, cycle, REFERENCE)
+    if before is None: # both failed by then, and only the candidate had differed before
+        return {'cycle': None, 'details': [
+            "differed between cycles {} and {}, then both failed".format(lo, hi)]}
+    (ref, ref_error, _) = rerun(snapshot, ipf, events, cycle + 1, REFERENCE)
+    (cand, cand_error, _) = rerun(snapshot, ipf, events, cycle + 1, candidate())
+    if ref_error is not None or cand_error is not None:
+        details = ["reference: {}".format(ref_error or "ok"), "candidate: {}".format(cand_error or "ok")]
+    else:
+        details = state_diff(ref, cand)
+    return {'cycle': cycle, 'pc': before.pc, 'instruction': instruction_at(before),
+            'details': details}
+
+def check(job):
+    candidate = CANDIDATES[job['engine']]
+    ipf = job['ipf']
+    events = read_input_script(job['script']) if job['script'] is not None else []
+    step = job['interval'] * ipf # whole frames, so every check starts a frame
+
+    start = time.perf_counter()
+    quirks = parse_quirks(job['quirks'])
+    snapshot = save_state(load_rom(default_state(job['seed'], quirks), job['rom']))
+    # Both keep running from their own states, so the candidate keeps its
+    # caches from one check to the next as it would in a normal run
+    run = candidate()
+    (ref, cand) = ((load_state(snapshot), None, None), (load_state(snapshot), None, None))
+    cycles = 0
+    result = {'rom': job['rom'], 'script': job['script'], 'divergence': None, 'error': None}
+    while cycles < job['cycles'] and ref[0].is_running:
+        target = min(job['cycles'], cycles + step)
+        ref  = run_checked(ref[0], ipf, events, target, REFERENCE)
+        cand = run_checked(cand[0], ipf, events, target, run)
+        if outcome(ref) != outcome(cand):
+            result['divergence'] = divergence(snapshot, cycles, target, ipf, events, candidate)
+            break
+        if ref[1] is not None: # both failed, and in the same way as far as hashes go
+            result['error'] = ref[1]
+            break
+        snapshot = save_state(ref[0])
+        cycles = target
+    result['cycles'] = cycles
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def result_to_str(result):
+    name = result['rom'] + (" " + result['script'] if result['script'] is not None else "")
+    d = result['divergence']
+    if d is None:
+        status = "ok" if result['error'] is None else "ok, both failed: " + result['error']
+        return "{}: {} after {} cycles, {:.1f} s".format(name, status, result['cycles'], result['seconds'])
+    if d['cycle'] is None:
+        lines = ["{}: DIFFERS".format(name)]
+    else:
+        lines = ["{}: DIFFERS after cycle {}, pc 0x{:03X}: {}".format(
+            name, d['cycle'], d['pc'], d['instruction'])]
+    return '\n'.join(lines + ["    " + line for line in d['details']])
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Check a Chip8 engine against the interpreter")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="ROM files, or directories searched for *.ch8 and *.c8")
+    parser.add_argument("--engine", choices=sorted(CANDIDATES), default="blocks",
+                        help="engine checked against the interpreter (default: %(default)s)")
+    parser.add_argument("--cycles", type=int, default=1000000,
+                        help="instructions to run per ROM and input script (default: %(default)s)")
+    parser.add_argument("--interval", type=int, default=600,
+                        help="frames between two comparisons (default: %(default)s)")
+    parser.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME,
+                        help="instructions per 1/60 s frame (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="seed of every machine's random number generator (default: %(default)s)")
+    parser.add_argument("--quirks", default="chippy", metavar="PROFILE",
+                        help="quirk profile of the ROMs without a .quirks file next to them, "
+                             "see main.py --help (default: %(default)s)")
+    args = parser.parse_args(argv)
+    try:
+        parse_quirks(args.quirks)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    jobs = [{'rom': rom, 'script': script, 'engine': args.engine, 'cycles': args.cycles,
+             'interval': args.interval, 'ipf': args.ipf, 'seed': args.seed,
+             'quirks': find_quirks(rom, args.quirks)}
+            for rom in find_roms(args.paths) for script in find_scripts(rom) or [None]]
+
+    differs = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for future in as_completed([pool.submit(check, job) for job in jobs]):
+            result = future.result()
+            if result['divergence'] is not None:
+                differs += 1
+            print(result_to_str(result), flush=True)
+    print("{} checked, {} differ".format(len(jobs), differs), file=sys.stderr)
+    sys.exit(1 if differs else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,665 +1,109 @@
+import os
 import sys
-from copy import deepcopy
-import enum
-import random
-import pygame
+import time
+import argparse
+from chip8 import *
+from blocks import run_blocks
+from profiler import Profile, profiled, profiled_runner, dump_profile
+from savestate import Rewind, rewind_push, rewind_pop, write_state, read_state
+from replay import start_recording, restart_recording, record_keys, rewind_recording
+from replay import write_recording, read_recording, replay
+from terminal import TerminalScreen, open_terminal, draw_terminal_impure, close_terminal
+from idle import idle_runner
+from romcache import CACHE_DIR, load_rom_cached
+from export import open_export, export_frame, exported, close_export
+from capture import start_capture, capture_frame, stop_capture, capture_report
+
+pygame = None # imported by init_pygame(), headless runs never load it
 
-BASE_WIDTH  = 64
-BASE_HEIGHT = 32
 SCALE_FACTOR = 10
 
+ENGINES = {
+    'interpreter': run_instructions,
+    'blocks':      run_blocks,
+}
+
 WINDOW_WIDTH  = BASE_WIDTH  * SCALE_FACTOR
 WINDOW_HEIGHT = BASE_HEIGHT * SCALE_FACTOR
 
-_KB = 1024
-_4KB = 4 * _KB
-
-main_memory = [0] * _4KB
-
-pygame.init()
-
-def empty_display(): # 64 pixels wide * 32 pixels tall
-    res = []
-    base = [False] * 64
-    for x in range(32):
-        res += [base[:]]
-    return res
-
-def safe_push(stack, x):
-    copy = stack[:]
-    copy.append(x)
-    assert len(copy) <= 16
-    return copy
-
-def safe_pop(stack):
-    assert len(stack) > 0
-    copy = stack[:]
-    return copy[:-1]
-
-def top(stack):
-    assert len(stack) > 0
-    return stack[:][-1]
-
-def empty_memory():
-    return [0] * _4KB
-
-def reg_index(reg):
-    assert len(reg) == 1 and type(reg) == str
-    REG = reg.upper()
-    return "0123456789ABCDEF".find(REG)
-
-def reg_value(state, reg):
-    regs = state['regs']
-    assert reg_index(reg) < len(regs)
-    return regs[reg_index(reg)]
-
-def set_reg(state, reg, value):
-    new_state = state
-    regs = new_state['regs']
-    print("reg: {}, value: {}".format(reg, value))
-    assert reg_index(reg) < len(regs)
-    assert value < 2**15 and value >= -(2 ** 15)
-    regs[reg_index(reg)] = value
-    new_state['regs'] = regs
-    return new_state
-
-def memory_with_loaded_fonts(_mem):
-    mem = _mem[:]
-    assert len(mem) == 4096
-    [
-            (_0_start, _0_end),
-            (_1_start, _1_end),
-            (_2_start, _2_end),
-            (_3_start, _3_end),
-            (_4_start, _4_end),
-            (_5_start, _5_end),
-            (_6_start, _6_end),
-            (_7_start, _7_end),
-            (_8_start, _8_end),
-            (_9_start, _9_end),
-            (_A_start, _A_end),
-            (_B_start, _B_end),
-            (_C_start, _C_end),
-            (_D_start, _D_end),
-            (_E_start, _E_end),
-            (_F_start, _F_end)
-    ] = [(x, x + 5) for x in range(0x50, 0x9F, 5)[:16]]
-    
-    assert _0_start == 0x50 and _F_end == 0xA0
-
-    _0 = [0xF0, 0x90, 0x90, 0x90, 0xF0]; mem[_0_start : _0_end] = _0
-    _1 = [0x20, 0x60, 0x20, 0x20, 0x70]; mem[_1_start : _1_end] = _1
-    _2 = [0xF0, 0x10, 0xF0, 0x80, 0xF0]; mem[_2_start : _2_end] = _2
-    _3 = [0xF0, 0x10, 0xF0, 0x10, 0xF0]; mem[_3_start : _3_end] = _3
-    _4 = [0x90, 0x90, 0xF0, 0x10, 0x10]; mem[_4_start : _4_end] = _4
-    _5 = [0xF0, 0x80, 0xF0, 0x10, 0xF0]; mem[_5_start : _5_end] = _5
-    _6 = [0xF0, 0x80, 0xF0, 0x90, 0xF0]; mem[_6_start : _6_end] = _6
-    _7 = [0xF0, 0x10, 0x20, 0x40, 0x40]; mem[_7_start : _7_end] = _7
-    _8 = [0xF0, 0x90, 0xF0, 0x90, 0xF0]; mem[_8_start : _8_end] = _8
-    _9 = [0xF0, 0x90, 0xF0, 0x10, 0xF0]; mem[_9_start : _9_end] = _9
-    _A = [0xF0, 0x90, 0xF0, 0x90, 0x90]; mem[_A_start : _A_end] = _A
-    _B = [0xE0, 0x90, 0xE0, 0x90, 0xE0]; mem[_B_start : _B_end] = _B
-    _C = [0xF0, 0x80, 0x80, 0x80, 0xF0]; mem[_C_start : _C_end] = _C
-    _D = [0xE0, 0x90, 0x90, 0x90, 0xE0]; mem[_D_start : _D_end] = _D
-    _E = [0xF0, 0x80, 0xE0, 0x80, 0xF0]; mem[_E_start : _E_end] = _E
-    _F = [0xF0, 0x80, 0xF0, 0x80, 0x80]; mem[_F_start : _F_end] = _F
-
-    assert len(mem) == 4096
-
-    return mem
-
-def memory_with_loaded_fonts_from_state(state):
-    mem = state['memory'][:]
-    return memory_with_loaded_fonts(mem)
-
-def default_state():
-    return {
-        'is_running': True,
-        'pc': 0x200, # program counter
-        'index': 0,
-        'sound_timer': 0,
-        'delay_timer': 0,
-        'memory': memory_with_loaded_fonts(empty_memory()),
-        'display': empty_display(),
-        'stack': [], # stack for subroutines
-        'regs': [0] * 16,
-        'keys': [False] * 16,
-    }
-
-
-def fetch_opcode(state):
-    new_state = state
-    pc  = state['pc']
-    mem = state['memory']
-    print("PC: {}".format(pc))
-    op1, op2 = mem[pc], mem[pc + 1]
-    new_state['pc'] = pc + 2
-    return (op1 << 8 | op2, new_state)
-
-( Nop
-, ClearScreen
-, Return
-, Jump
-, Call
-, SkipCondEq
-, SkipCondNEq
-, SkipCondRegEq
-, SkipCondRegNEq
-, Set
-, Add
-, SetR
-, BinOr
-, BinAnd
-, BinXor
-, AddR
-, Sub12
-, Sub21
-, ShiftL
-, ShiftR
-, SetIndex
-, JumpOffset
-, Random
-, Display
-, SkipIfPressed
-, SkipIfNotPressed
-, RegFromDelayTimer
-, DelayTimerFromReg
-, SoundTimerFromReg
-, AddToIndex
-, GetPressedValue
-, FontCharacter
-, HexToDecimalToIndex
-, StoreRegs
-, LoadRegs 
-) = range(35)
-
-def op_to_str(op):
-    if op == Nop:                 return "Nop"
-    if op == ClearScreen:         return "ClearScreen"
-    if op == Return:              return "Return"
-    if op == Jump:                return "Jump"
-    if op == Call:                return "Call"
-    if op == SkipCondEq:          return "SkipCondEq"
-    if op == SkipCondNEq:         return "SkipCondNEq"
-    if op == SkipCondRegEq:       return "SkipCondRegEq"
-    if op == SkipCondRegNEq:      return "SkipCondRegNEq"
-    if op == Set:                 return "Set"
-    if op == Add:                 return "Add"
-    if op == SetR:                return "SetR"
-    if op == BinOr:               return "BinOr"
-    if op == BinAnd:              return "BinAnd"
-    if op == BinXor:              return "BinXor"
-    if op == AddR:                return "AddR"
-    if op == Sub12:               return "Sub12"
-    if op == Sub21:               return "Sub21"
-    if op == ShiftL:              return "ShiftL"
-    if op == ShiftR:              return "ShiftR"
-    if op == SetIndex:            return "SetIndex"
-    if op == JumpOffset:          return "JumpOffset"
-    if op == Random:              return "Random"
-    if op == Display:             return "Display"
-    if op == SkipIfPressed:       return "SkipIfPressed"
-    if op == SkipIfNotPressed:    return "SkipIfNotPressed"
-    if op == RegFromDelayTimer:   return "RegFromDelayTimer"
-    if op == DelayTimerFromReg:   return "DelayTimerFromReg"
-    if op == SoundTimerFromReg:   return "SoundTimerFromReg"
-    if op == AddToIndex:          return "AddToIndex"
-    if op == GetPressedValue:     return "GetPressedValue"
-    if op == FontCharacter:       return "FontCharacter"
-    if op == HexToDecimalToIndex: return "HexToDecimalToIndex"
-    if op == StoreRegs:           return "StoreRegs"
-    if op == LoadRegs:            return "LoadRegs"
-    return "Undefined"
-
-def instruction_to_str(x):
-    res = str(tuple([op_to_str(x[0])] + list(x)[1:]))
-    return res
-
-def decode_opcode(opcode):
-    assert opcode >= 0 and opcode < 2 ** 16
-
-    def digit_to_reg(d):
-        assert d >= 0 and d < 16
-        return "0123456789ABCDEF"[d]
-
-    def first_digit (opcode): return opcode >> 12
-    def second_digit(opcode): return (opcode >> 8) & 15
-    def third_digit (opcode): return (opcode >> 4) & 15
-    def fourth_digit(opcode): return opcode & 15
-
-    def last_three  (opcode): return opcode & ((1 << 12) - 1)
-    def last_two    (opcode): return opcode & ((1 << 8) - 1)
-
-    def opcode_in_hex(opcode):
-        return "0x{}{}{}{}".format(
-            digit_to_reg(first_digit (opcode)),
-            digit_to_reg(second_digit(opcode)),
-            digit_to_reg(third_digit (opcode)),
-            digit_to_reg(fourth_digit(opcode))
-        )
-
-    fr_dg = first_digit(opcode)
-
-    if opcode == 0x00E0:
-        return (ClearScreen, )
-    if opcode == 0x00EE:
-        return (Return, )
-    if fr_dg == 0x0:
-        return (Nop, )
-    if fr_dg == 0x1:
-        return (Jump, last_three(opcode))
-    if fr_dg == 0x2:
-        return (Call, last_three(opcode))
-    if fr_dg == 0x3:
-        reg = digit_to_reg(second_digit(opcode))
-        return (SkipCondEq, reg, last_two(opcode))
-    if fr_dg == 0x4:
-        reg = digit_to_reg(second_digit(opcode))
-        return (SkipCondNEq, reg, last_two(opcode))
-    if fr_dg == 0x5:
-        reg1 = digit_to_reg(second_digit(opcode))
-        reg2 = digit_to_reg(third_digit (opcode))
-        return (SkipCondRegEq, reg1, reg2)
-    if fr_dg == 0x9:
-        reg1 = digit_to_reg(second_digit(opcode))
-        reg2 = digit_to_reg(third_digit (opcode))
-        return (SkipCondRegNEq, reg1, reg2)
-    if fr_dg == 0x6:
-        reg = digit_to_reg(second_digit(opcode))
-        return (Set, reg, last_two(opcode))
-    if fr_dg == 0x7:
-        reg = digit_to_reg(second_digit(opcode))
-        return (Add, reg, last_two(opcode))
-    if fr_dg == 0x8:
-        lst_dg = fourth_digit(opcode)
-
-        reg1 = digit_to_reg(second_digit(opcode))
-        reg2 = digit_to_reg(third_digit(opcode))
-
-        if lst_dg == 0x0:
-            return (SetR, reg1, reg2)
-        if lst_dg == 0x1:
-            return (BinOr, reg1, reg2)
-        if lst_dg == 0x2:
-            return (BinAnd, reg1, reg2)
-        if lst_dg == 0x3:
-            return (BinXor, reg1, reg2)
-        if lst_dg == 0x4:
-            return (AddR, reg1, reg2)
-        if lst_dg == 0x5:
-            return (Sub12, reg1, reg2)
-        if lst_dg == 0x7:
-            return (Sub21, reg1, reg2)
-        if lst_dg == 0x6:
-            return (ShiftL, reg1, reg2)
-        if lst_dg == 0xE:
-            return (ShiftR, reg1, reg2)
-
-    if fr_dg == 0xA:
-        return (SetIndex, last_three(opcode))
-    if fr_dg == 0xB:
-        return (JumpOffset, last_three(opcode))
-    if fr_dg == 0xC:
-        reg = digit_to_reg(second_digit(opcode))
-        and_val = last_two(opcode)
-        return (Random, reg, and_val)
-    if fr_dg == 0xD:
-        reg1 = digit_to_reg(second_digit(opcode))
-        reg2 = digit_to_reg(third_digit(opcode))
-        height = fourth_digit(opcode)
-        return (Display, reg1, reg2, height)
-    if fr_dg == 0xE and last_two(opcode) == 0x9E:
-        reg = digit_to_reg(second_digit(opcode))
-        return (SkipIfPressed, reg)
-    if fr_dg == 0xE and last_two(opcode) == 0xA1:
-        reg = digit_to_reg(second_digit(opcode))
-        return (SkipIfNotPressed, reg)
-
-    if fr_dg == 0xF:
-        reg = digit_to_reg(second_digit(opcode))
-        lst_dgs = last_two(opcode)
-
-        if lst_dgs == 0x07:
-            return (RegFromDelayTimer, reg)
-        if lst_dgs == 0x15:
-            return (DelayTimerFromReg, reg)
-        if lst_dgs == 0x18:
-            return (SoundTimerFromReg, reg)
-        if lst_dgs == 0x1E:
-            return (AddToIndex, reg)
-        if lst_dgs == 0x0A:
-            return (GetPressedValue, reg)
-        if lst_dgs == 0x29:
-            return (FontCharacter, reg)
-        if lst_dgs == 0x33:
-            return (HexToDecimalToIndex, reg)
-        if lst_dgs == 0x55:
-            return (StoreRegs, reg)
-        if lst_dgs == 0x65:
-            return (LoadRegs, reg)
-
-    print("Unknown instruction! {}".format(opcode_in_hex(opcode)))
-    assert False
-
-def exec_instruction(state, instruction):
-    new_state = state
-    op = instruction[0]
-
-    if op == ClearScreen:
-        new_state['dipslay'] = empty_display()
-
-    if op == Return:
-        stack = new_state['stack']
-        pc = top(stack)
-        stack = safe_pop(stack)
-        new_state['stack'] = stack
-        new_state['pc']    = pc
-
-    if op == Nop:
-        pass
-
-    if op == Jump:
-        (_, new_pc) = instruction
-        new_state['pc'] = new_pc
-
-    if op == Call:
-        (_, new_pc) = instruction
-        stack = safe_push(new_state['stack'], new_state['pc'])
-        new_state['pc'] = new_pc
-        new_state['stack'] = stack
-
-    if op == SkipCondEq:
-        (_, reg, val) = instruction
-        reg_val = reg_value(new_state, reg)
-        if reg_val == val:
-            new_state['pc'] = new_state['pc'] + 2
-
-    if op == SkipCondNEq:
-        (_, reg, val) = instruction
-        reg_val = reg_value(new_state, reg)
-        if reg_val != val:
-            new_state['pc'] = new_state['pc'] + 2
-
-    if op == SkipCondRegEq:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        if reg_val1 == reg_val2:
-            new_state['pc'] = new_state['pc'] + 2
-
-    if op == SkipCondRegNEq:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        if reg_val1 != reg_val2:
-            new_state['pc'] = new_state['pc'] + 2
-
-    if op == Set:
-        (_, reg, val) = instruction
-        new_state = set_reg(new_state, reg, val)
-
-    if op == Add:
-        (_, reg, val) = instruction
-        reg_val = reg_value(new_state, reg) + val
-        new_state = set_reg(new_state, reg, reg_val)
-
-    if op == SetR:
-        (_, reg1, reg2) = instruction
-        reg_val2 = reg_value(new_state, reg2)
-        new_state = set_reg(new_state, reg1, reg_val2)
-
-    if op == BinOr:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        new_val = reg_val1 | reg_val2
-        new_state = set_reg(new_state, reg1, new_val)
-
-    if op == BinAnd:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        new_val = reg_val1 & reg_val2
-        new_state = set_reg(new_state, reg1, new_val)
-
-    if op == BinXor:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        new_val = reg_val1 ^ reg_val2
-        new_state = set_reg(new_state, reg1, new_val)
-
-    if op == AddR:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        new_val = reg_val1 + reg_val2
-        new_state = set_reg(new_state, reg1, new_val)
-
-    if op == Sub12:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        new_val = reg_val1 - reg_val2
-        new_state = set_reg(new_state, reg1, new_val)
-
-    if op == Sub21:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        reg_val2 = reg_value(new_state, reg2)
-        new_val = reg_val2 - reg_val2
-        new_state = set_reg(new_state, reg1, new_val)
-
-    if op == ShiftL:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        new_val = reg_val1 << 1
-        shifted_out = reg_val1 & (1 << 15)
-        new_state = set_reg(new_state, reg1, new_val)
-        new_state = set_reg(new_state, "F", shifted_out)
-
-    if op == ShiftR:
-        (_, reg1, reg2) = instruction
-        reg_val1 = reg_value(new_state, reg1)
-        new_val = reg_val1 >> 1
-        shifted_out = reg_val1 & 1
-        new_state = set_reg(new_state, reg1, new_val)
-        new_state = set_reg(new_state, "F", shifted_out)
-
-    if op == SetIndex:
-        (_, val) = instruction
-        new_state['index'] = val
-
-    if op == JumpOffset:
-        # TODO Make configurable
-        (_, val) = instruction
-        reg_val0 = reg_val(new_state, "0")
-        new_state['pc'] = val + reg_val0
-
-    if op == Random:
-        (_, reg, val) = instruction
-        randval = random.randint(0,1000) & val
-        new_state = set_reg(new_state, reg, randval)
-
-    if op == Display:
-        (_, rx, ry, h) = instruction
-        x = reg_value(new_state, rx) & 63
-        y = reg_value(new_state, ry) & 31
-
-        set_vf = 0
-
-        old_display = new_state['display']
-        display = old_display[:]
-        index   = new_state['index']
-        memory  = new_state['memory']
-
-        x_vals = range(x, min(x + 8, 64))
-        y_vals = range(y, min(y + h, 32))
-
-        for i, y in zip(range(h), y_vals):
-            b = memory[index + i]
-            for offset, x in zip(range(8), x_vals):
-                if (b >> (7 - offset)) & 1 == 1:
-                    if display[y][x] == True:
-                        display[y][x] = False
-                        set_vf = 1
-                    else:
-                        display[y][x] = True
-
-        new_state['display'] = display
-        new_state = set_reg(new_state, "F", set_vf)
-
-    if op == SkipIfPressed:
-        (_, reg) = instruction
-        assert reg >= 0 and reg < 16
-        reg_val = reg_value(new_state, reg)
-        keys = new_state['keys']
-        if keys[reg_val] == True:
-            new_state['pc'] += 2
-
-    if op == SkipIfNotPressed:
-        (_, reg) = instruction
-        assert reg >= 0 and reg < 16
-        reg_val = reg_value(new_state, reg)
-        keys = new_state['keys']
-        if keys[reg_val] == False:
-            new_state['pc'] += 2
-
-    if op == RegFromDelayTimer:
-        (_, reg) = instruction
-        new_state = set_reg(new_state, reg, new_state['delay'])
-
-    if op == DelayTimerFromReg:
-        (_, reg) = instruction
-        reg_val = reg_value(new_state, reg)
-        new_state['delay'] = reg_val
-
-    if op == SoundTimerFromReg:
-        (_, reg) = instruction
-        reg_val = reg_value(new_state, reg)
-        new_state['sound'] = reg_val
-
-    if op == AddToIndex:
-        (_, reg) = instruction
-        reg_val = reg_value(new_state, reg)
-        new_state['index'] += reg_val
-
-    if op == GetPressedValue:
-        (_, reg) = instruction
-        keys = new_state['keys']
-        stored = False
-        for i, x in enumerate(keys):
-            if x == True:
-                new_state = set_reg(new_state, reg, i)
-                stored = True
-                break
+def init_pygame():
+    global pygame
+    import pygame
+    pygame.init()
 
-        if stored == False:
-            new_state['pc'] -= 2
-
-    if op == FontCharacter:
-        (_, reg) = instruction
-        reg_val = reg_value(new_state, reg)
-        assert reg_val >= 0 and reg_val < 16
-        new_state['index'] = reg_val * 5 + 0x50
-
-    if op == HexToDecimalToIndex:
-        (_, reg) = instruction
-        reg_val = reg_value(new_state, reg)
-        memory = new_state['memory']
-        index  = new_state['index']
-        memory[index + 0] = reg_val // 100
-        memory[index + 1] = (reg_val // 10) % 10
-        memory[index + 2] = reg_val % 10
-        new_state['memory'] = memory
-
-    if op == StoreRegs:
-        (_, reg) = instruction
-        regs = new_state['regs']
-        memory = new_state['memory']
-        index = new_state['index']
-        end = reg_index(reg)
-        regs = regs[:end + 1]
-        for i, val in enumerate(regs):
-            memory[index + i] = val
-        new_state['memory'] = memory
-
-    if op == LoadRegs:
-        (_, reg) = instruction
-        regs = new_state['regs']
-        memory = new_state['memory']
-        index = new_state['index']
-        end = reg_index(reg)
-        for i, val in enumerate(range(index, index + end + 1)):
-            regs[i] = val
-        new_state['regs'] = regs
-
-    return new_state
+# 8 palette indices (0 or 1) for every possible sprite byte
+BYTE_PIXELS = [bytes((b >> (7 - i)) & 1 for i in range(8)) for b in range(256)]
 
-def fetch_decode_exec(state):
-    new_state = state
-    (opcode, new_state) = fetch_opcode(state)
-    instruction         = decode_opcode(opcode)
-    #print("PC: {}, {}".format(new_state['pc'] - 2, instruction_to_str(instruction)))
-    new_state           = exec_instruction(new_state, instruction)
-    return new_state
+def row_pixels(row):
+    return b''.join([BYTE_PIXELS[(row >> shift) & 0xFF] for shift in range(56, -8, -8)])
 
-def draw_to_terminal(state):
-    display = state['display']
-    res = '\n'.join([''.join(['  ' if x == False else '##' for x in line]) for line in display])
-    print(res)
-    return res
+def make_window(scale_factor):
+    screen = pygame.display.set_mode((BASE_WIDTH * scale_factor, BASE_HEIGHT * scale_factor))
+    native = pygame.Surface((BASE_WIDTH, BASE_HEIGHT), depth=8)
+    native.set_palette([(0, 0, 0), (255, 255, 255)]) # Black, White
+    # transform.scale only writes to a surface of its own format, so rows
+    # are scaled into this one and then blitted onto the screen
+    scaled = pygame.Surface(screen.get_size(), depth=8)
+    scaled.set_palette([(0, 0, 0), (255, 255, 255)])
+    return (screen, native, scaled, scale_factor)
 
 def draw_screen_impure(state, window):
-    (screen, scale_factor) = window
+    (screen, native, scaled, scale_factor) = window
+
+    if state.dirty == 0:
+        return
 
-    def color_is(val):
-        if val == True: return (255, 255, 255) # White
-        else:           return (  0,   0,   0) # Black
+    display = state.display
+    pitch   = native.get_pitch()
+    pixels  = native.get_buffer()
+    for start, end in dirty_runs(state.dirty):
+        for y in range(start, end):
+            pixels.write(row_pixels(display[y]), y * pitch)
+    del pixels # unlocks the surface
 
-    display = state['display']
-    for _y in range(len(display)):
-        for _x in range(len(display[_y])):
-            x_vals = range(_x * scale_factor, (_x + 1) * scale_factor)
-            y_vals = range(_y * scale_factor, (_y + 1) * scale_factor)
+    rects = []
+    for start, end in dirty_runs(state.dirty):
+        src  = native.subsurface((0, start, BASE_WIDTH, end - start))
+        rect = pygame.Rect(0, start * scale_factor, screen.get_width(), (end - start) * scale_factor)
+        pygame.transform.scale(src, rect.size, scaled.subsurface(rect))
+        screen.blit(scaled, rect, rect)
+        rects.append(rect)
 
-            color = color_is(display[_y][_x])
-            
-            for x in x_vals:
-                for y in y_vals:
-                    screen.set_at((x, y), color)
+    pygame.display.update(rects)
 
-    pygame.display.flip()
+def compile_keymap(keymap): # {key name: Chip8 key} -> {pygame key code: Chip8 key}
+    return {pygame.key.key_code(name): key for name, key in keymap.items()}
 
-def get_pressed_keys(state, keymap, keys):
+def get_pressed_keys(state, key_table, keys):
     new_state = state
-    pressed_keys = [False] * 16
-    for i, x in enumerate(keys):
-        c = chr(i)
-        if c in keymap.keys() and x == 1:
-            pressed_keys[keymap[c]] = True
-    new_state['keys'] = pressed_keys
+    pressed_keys = 0
+    for code, key in key_table.items():
+        if keys[code]:
+            pressed_keys |= 1 << key
+    new_state.keys = pressed_keys
     pygame.event.pump()
     return new_state
 
-def tick(state, keymap, keys, window):
+def update_keys(held, key_table, events): # the mask of held keys after `events`
+    for event in events:
+        if event.type == pygame.KEYDOWN and event.key in key_table:
+            held |= 1 << key_table[event.key]
+        elif event.type == pygame.KEYUP and event.key in key_table:
+            held &= ~(1 << key_table[event.key])
+        elif event.type == pygame.WINDOWFOCUSLOST: # its key ups go elsewhere
+            held = 0
+    return held
+
+def tick(state, key_table, keys, window):
     new_state = state.copy()
-    new_state = get_pressed_keys(new_state, keymap, keys)
-    new_state = fetch_decode_exec(new_state)
+    new_state = get_pressed_keys(new_state, key_table, keys)
+    try:
+        new_state = fetch_decode_exec(new_state)
+    except WaitingForKey:
+        pass
+    new_state.cycles += 1
     draw_screen_impure(new_state, window)
-    return new_state
-
-def load_rom(state, fname):
-    new_state = state
-    def read_rom(fname):
-        with open(fname, "rb") as f:
-            data = [x for x in f.read()]
-        return data
-
-    rom_data = read_rom(fname)
-    memory = new_state['memory']
-    memory = memory[0:0x200] + rom_data + [0] * (4096 - (len(rom_data) + 0x200))
-    new_state['memory'] = memory
+    new_state.dirty = 0
     return new_state
 
 def default_keymap():
@@ -668,23 +112,367 @@ def default_keymap():
             'a': 0x7, 's': 0x8, 'd': 0x9, 'f': 0xe,
             'z': 0xa, 'x': 0x0, 'c': 0xb, 'v': 0xf}
 
-def load_keymap():
-    # TODO Read from configuration file
-    return default_keymap()
+# A keymap file has a line "<key name> <Chip8 key in hex>" for every key,
+# with the names pygame uses: "x 0", "space 5", "left shift f"
+def load_keymap(fname=None):
+    if fname is None:
+        return default_keymap()
+    keymap = {}
+    with open(fname) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line == '':
+                continue
+            (name, key) = line.rsplit(None, 1)
+            keymap[name] = int(key, 16)
+            assert keymap[name] < 16, "No Chip8 key {}".format(key)
+    return keymap
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Chip8 emulator")
+    parser.add_argument("rom", nargs="?")
+    parser.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME,
+                        help="instructions per 1/60 s frame (default: %(default)s)")
+    parser.add_argument("--turbo", action="store_true",
+                        help="run as fast as possible instead of in real time")
+    parser.add_argument("--keymap", metavar="PATH",
+                        help="read the keymap from PATH, see README.md")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="interpreter",
+                        help="interpreter runs one instruction at a time, blocks compiles "
+                             "straight-line code into Python functions (default: %(default)s)")
+    parser.add_argument("--quirks", default="chippy", metavar="PROFILE",
+                        help="how the instructions Chip8 variants disagree on behave: one of "
+                             "{}, optionally followed by changes like ',sprite_wrap=1', see "
+                             "README.md; saved states and recordings keep their own "
+                             "(default: %(default)s)".format(', '.join(QUIRK_PROFILES)))
+    parser.add_argument("--no-idle", action="store_true",
+                        help="run idle loops instruction by instruction instead of skipping them")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window and print the final state hash")
+    parser.add_argument("--terminal", action="store_true",
+                        help="draw in the terminal instead of a window, until --cycles, "
+                             "--frames or Ctrl-C, and print the final state hash")
+    parser.add_argument("--cycles", type=int,
+                        help="headless: stop after this many instructions")
+    parser.add_argument("--frames", type=int,
+                        help="headless: stop after this many frames")
+    parser.add_argument("--dump-frame", metavar="PATH",
+                        help="headless: write the final frame as text, - for stdout")
+    parser.add_argument("--dump-raw", metavar="PATH",
+                        help="headless: write the final frame as 32 rows of 8 bytes")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="record the last instructions and write them to PATH on F9, "
+                             "on a failed assertion and at the end of a headless run; "
+                             "always uses the interpreter")
+    parser.add_argument("--trace-size", type=int, default=TRACE_CAPACITY,
+                        help="instructions kept by --trace (default: %(default)s)")
+    parser.add_argument("--read-trace", metavar="PATH",
+                        help="print a trace written by --trace and exit")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="count the ops and addresses that run and time every phase, "
+                             "write the report to PATH as JSON and print it on F10 and on "
+                             "exit; always uses the interpreter")
+    parser.add_argument("--rom-cache", default=CACHE_DIR, metavar="DIR",
+                        help="where ROMs are kept ready to run, by hash, see romcache.py (default: %(default)s)")
+    parser.add_argument("--no-rom-cache", action="store_true",
+                        help="do not keep an image of the ROM on disk")
+    parser.add_argument("--load-state", metavar="PATH",
+                        help="start from a state saved by --save-state instead of the start of the ROM")
+    parser.add_argument("--save-state", metavar="PATH",
+                        help="where F5 saves the state and F8 loads it from; "
+                             "headless: write the final state here")
+    parser.add_argument("--rewind", type=int, default=60, metavar="SECONDS",
+                        help="seconds kept for rewinding with Backspace, 0 to turn it off "
+                             "(default: %(default)s)")
+    parser.add_argument("--seed", type=int,
+                        help="seed of the random number generator (default: a random one in "
+                             "the window, {} headless)".format(DEFAULT_SEED))
+    parser.add_argument("--record", metavar="PATH",
+                        help="record the keys pressed in the window and write them to PATH on exit")
+    parser.add_argument("--export", metavar="PATH",
+                        help="share every frame, the registers and the frame count with other "
+                             "processes through PATH, mapped into memory, see export.py")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="write every frame shown to PATH: numbered PNGs for a .png, an "
+                             "animated GIF for a .gif, else raw bytes as in --dump-raw, one frame after the other")
+    parser.add_argument("--capture-every", type=int, default=1, metavar="N",
+                        help="capture only one frame of every N (default: %(default)s)")
+    parser.add_argument("--capture-scale", type=int, default=4,
+                        help="pixels per Chip8 pixel in PNGs and GIFs (default: %(default)s)")
+    parser.add_argument("--capture-queue", type=int, default=256, metavar="FRAMES",
+                        help="frames waiting to be written before more are dropped (default: %(default)s)")
+    parser.add_argument("--capture-policy", choices=("drop", "block"),
+                        help="when the capture queue is full, drop the frame or make the emulator "
+                             "wait (default: wait headless, drop otherwise)")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="run a recording made by --record headless, as fast as possible, "
+                             "and print the final state hash")
+    args = parser.parse_args(argv)
+    try:
+        args.quirks = parse_quirks(args.quirks)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.rom is None and args.read_trace is None and args.load_state is None and args.replay is None:
+        parser.error("the following arguments are required: rom")
+    if args.headless and args.cycles is None and args.frames is None:
+        parser.error("--headless needs --cycles or --frames")
+    if args.replay is not None and args.frames is not None:
+        parser.error("--replay stops after --cycles, not --frames")
+    if args.export is not None and args.replay is not None:
+        parser.error("--export cannot follow a --replay")
+    if args.capture is not None and args.replay is not None:
+        parser.error("--capture cannot follow a --replay")
+    if args.capture_every < 1 or args.capture_scale < 1 or args.capture_queue < 1:
+        parser.error("--capture-every, --capture-scale and --capture-queue must be at least 1")
+    if args.terminal and args.replay is not None:
+        parser.error("--terminal cannot show a --replay")
+    if args.trace is not None and args.profile is not None:
+        parser.error("--trace and --profile cannot be used together")
+    return args
+
+def poll_input(state, key_table, held): # -> (state, held, events)
+    new_state = state
+    events = pygame.event.get()
+    held = update_keys(held, key_table, events)
+    if any(event.type == pygame.QUIT for event in events):
+        new_state.is_running = False
+    new_state.keys = held
+    return (new_state, held, events)
+
+def wait_for_event(deadline): # leaves the event in the queue for poll_input
+    timeout = int((deadline - time.perf_counter()) * 1000)
+    if timeout <= 0:
+        return False
+    event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return False
+    pygame.event.post(event)
+    return True
+
+def make_runner(args, trace, profile):
+    if trace is not None:
+        return traced_runner(trace)
+    if profile is not None:
+        return profiled_runner(profile)
+    if args.no_idle:
+        return ENGINES[args.engine]
+    return idle_runner(ENGINES[args.engine])
+
+def report_profile(args, profile):
+    print(dump_profile(profile, args.profile), file=sys.stderr)
+
+def initial_state(args, seed):
+    if args.load_state is not None:
+        return read_state(args.load_state)
+    rom_cache = None if args.no_rom_cache else args.rom_cache
+    return load_rom_cached(default_state(seed, args.quirks), args.rom, rom_cache)
+
+# run_for, a frame at a time so that every one is exported and captured
+def run_frames(state, args, run, export, capture):
+    new_state = state
+    frames = 0
+    while new_state.is_running:
+        if args.frames is not None and frames >= args.frames:
+            break
+        if args.cycles is not None and new_state.cycles >= args.cycles:
+            break
+        new_state = run_for(new_state, args.ipf, args.cycles, 1, run)
+        if export is not None:
+            export_frame(export, new_state)
+        if capture is not None:
+            capture_frame(capture, new_state)
+        frames += 1
+    return new_state
+
+def main_headless(args, trace, profile, export, capture):
+    run = make_runner(args, trace, profile)
+    if args.replay is not None:
+        state = replay(read_recording(args.replay), args.cycles, run)
+    else:
+        seed = args.seed if args.seed is not None else DEFAULT_SEED
+        state = initial_state(args, seed)
+        if export is None and capture is None:
+            state = run_for(state, args.ipf, args.cycles, args.frames, run)
+        else:
+            state = run_frames(state, args, run, export, capture)
+
+    if args.dump_frame == "-":
+        draw_to_terminal(state)
+    elif args.dump_frame is not None:
+        with open(args.dump_frame, "w") as f:
+            f.write(display_to_str(state.display) + "\n")
+    if args.dump_raw is not None:
+        with open(args.dump_raw, "wb") as f:
+            f.write(display_to_bytes(state.display))
+
+    if args.save_state is not None:
+        write_state(state, args.save_state)
+    if trace is not None:
+        dump_trace(trace, args.trace)
+
+    print(state_hash(state))
+
+def main_terminal(args, trace, profile, export, capture):
+    seed = args.seed if args.seed is not None else DEFAULT_SEED
+    state = initial_state(args, seed)
+    run = make_runner(args, trace, profile)
+    frame = exported(export, run_frame) if export is not None else run_frame
+    screen = TerminalScreen()
+
+    open_terminal(screen)
+    next_present = time.perf_counter()
+    frames = 0
+    try:
+        while state.is_running:
+            if args.frames is not None and frames >= args.frames:
+                break
+            if args.cycles is not None and args.cycles - state.cycles < args.ipf:
+                state = run(state, max(args.cycles - state.cycles, 0))
+                break
+            now = time.perf_counter()
+            if now >= next_present:
+                draw_terminal_impure(state, screen)
+                if capture is not None:
+                    capture_frame(capture, state)
+                next_present = max(next_present + FRAME_TIME, now)
+
+            state = frame(state, args.ipf, run)
+            frames += 1
+
+            if not args.turbo:
+                delay = next_present - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        draw_terminal_impure(state, screen)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_terminal(screen)
+    print(state_hash(state))
+
+def main_window(args, trace, profile, export, capture):
+    init_pygame()
+    seed = args.seed if args.seed is not None else int.from_bytes(os.urandom(4), 'little')
+    state = initial_state(args, seed)
+    key_table = compile_keymap(load_keymap(args.keymap))
+    recording = start_recording(state, args.ipf) if args.record is not None else None
+    try:
+        run_window(args, trace, profile, export, capture, state, key_table, recording)
+    finally:
+        if recording is not None:
+            write_recording(recording, args.record)
+
+def run_window(args, trace, profile, export, capture, state, key_table, recording):
+    rewind = Rewind(args.rewind * FRAME_RATE) if args.rewind > 0 else None
+
+    window = make_window(SCALE_FACTOR)
+    run = make_runner(args, trace, profile)
+
+    (poll, draw, frame) = (poll_input, draw_screen_impure, run_frame)
+    if profile is not None:
+        poll  = profiled(profile, 'input', poll_input)
+        draw  = profiled(profile, 'render', draw_screen_impure)
+        frame = profiled(profile, 'frame', run_frame) # includes fetch, decode and exec
+    if export is not None:
+        frame = exported(export, frame)
+
+    # Input and presentation happen once per host frame. In real time that
+    # is once per emulated frame, in turbo mode frames run back to back.
+    next_present = time.perf_counter()
+    next_report  = next_present + 1
+    last_cycles  = state.cycles
+    rewinding    = False
+    held         = 0 # Chip8 keys held down, kept up to date from key events
+    while state.is_running:
+        now = time.perf_counter()
+        if now >= next_present:
+            # While Backspace is held every host frame steps back one frame
+            rewinding = rewind is not None and pygame.key.get_pressed()[pygame.K_BACKSPACE]
+            if rewinding:
+                state = rewind_pop(rewind, state) or state
+                if recording is not None:
+                    rewind_recording(recording, state)
+            elif rewind is not None:
+                rewind_push(rewind, state)
+            (state, held, events) = poll(state, key_table, held)
+            for event in events:
+                if event.type != pygame.KEYDOWN:
+                    continue
+                if event.key == pygame.K_F9 and trace is not None:
+                    dump_trace(trace, args.trace)
+                if event.key == pygame.K_F10 and profile is not None:
+                    report_profile(args, profile)
+                if event.key == pygame.K_F5 and args.save_state is not None:
+                    write_state(state, args.save_state)
+                if event.key == pygame.K_F8 and args.save_state is not None:
+                    state = read_state(args.save_state, state)
+                    state.keys = held
+                    if recording is not None:
+                        restart_recording(recording, state)
+            if recording is not None:
+                record_keys(recording, state)
+            draw(state, window)
+            if capture is not None:
+                capture_frame(capture, state)
+            state.dirty = 0
+            next_present = max(next_present + FRAME_TIME, now)
+        if now >= next_report:
+            ips = state.cycles - last_cycles
+            pygame.display.set_caption("chippy - {} instructions/s".format(ips))
+            last_cycles = state.cycles
+            next_report = now + 1
+
+        if rewinding:
+            pass
+        elif (args.turbo and (waiting_for_key(state) or idle_for_good(state))
+              and state.delay_timer == state.sound_timer == 0):
+            # Nothing changes until a key is pressed, so wait for one
+            # instead of running frames back to back
+            if wait_for_event(next_present):
+                next_present = time.perf_counter()
+        else:
+            state = frame(state, args.ipf, run)
+
+        if not args.turbo:
+            delay = next_present - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
 
 def main():
-    args = sys.argv
-    assert len(args) != 1
-    rom_name = args[1]
-    state = load_rom(default_state(), rom_name)
-    keymap = load_keymap()
-    
-    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-    window = (screen, SCALE_FACTOR)
-
-    while True:
-        keys = pygame.key.get_pressed()
-        state = tick(state, keymap, keys, window)
+    args = parse_args(sys.argv[1:])
+    if args.read_trace is not None:
+        for record in read_trace(args.read_trace):
+            print(trace_record_to_str(record))
+        return
+
+    trace = Trace(args.trace_size) if args.trace is not None else None
+    profile = Profile() if args.profile is not None else None
+    export = open_export(args.export) if args.export is not None else None
+    capture = None
+    if args.capture is not None:
+        policy = args.capture_policy or ("block" if args.headless else "drop")
+        capture = start_capture(args.capture, args.capture_scale, args.capture_every,
+                                args.capture_queue, policy == "block")
+    try:
+        if args.terminal:
+            main_terminal(args, trace, profile, export, capture)
+        elif args.headless or args.replay is not None:
+            main_headless(args, trace, profile, export, capture)
+        else:
+            main_window(args, trace, profile, export, capture)
+    except AssertionError:
+        if trace is not None:
+            dump_trace(trace, args.trace)
+            print("Trace written to {}".format(args.trace), file=sys.stderr)
+        raise
+    finally:
+        if profile is not None:
+            report_profile(args, profile)
+        if export is not None:
+            close_export(export)
+        if capture is not None:
+            stop_capture(capture)
+            print(capture_report(capture), file=sys.stderr)
 
 if __name__ == "__main__":
     main()
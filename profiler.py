@@ -0,0 +1,114 @@
+# Counts how often every op and every address runs and how long each phase
+# takes. Like tracing, it lives in its own runner that replaces the engine
+# while profiling, so the normal run loops do not check for it.
+import json
+from time import perf_counter_ns
+from chip8 import *
+
+PHASES = ('fetch', 'decode', 'exec', 'input', 'render', 'frame')
+
+HOT_PCS = 20
+
+class Profile:
+    __slots__ = ('ops', 'pcs', 'instructions', 'phase_ns', 'phase_calls')
+
+    def __init__(self):
+        self.ops          = [0] * len(OP_NAMES)
+        self.pcs          = [0] * 4096 # one per address
+        self.instructions = {} # pc -> last instruction run there
+        self.phase_ns     = dict.fromkeys(PHASES, 0)
+        self.phase_calls  = dict.fromkeys(PHASES, 0)
+
+def add_phase(profile, phase, ns, calls=1):
+    profile.phase_ns[phase] += ns
+    profile.phase_calls[phase] += calls
+
+# fetch_decode_exec with a clock around every step. A hit in the decode
+# cache counts as a fetch only.
+def profiled_fetch_decode_exec(state, profile):
+    new_state = state
+    t0 = perf_counter_ns()
+    pc = new_state.pc
+    page = new_state.memory.pages[pc >> PAGE_BITS]
+    entry = new_state.decoded.get(pc)
+    if entry is None or entry[0] is not page:
+        (opcode, new_state) = fetch_opcode(new_state)
+        t1 = perf_counter_ns()
+        instruction = decode_opcode(opcode)
+        entry       = (page, new_state.handlers[instruction[0]], instruction)
+        if pc & PAGE_MASK != PAGE_MASK:
+            new_state.decoded[pc] = entry
+        t2 = perf_counter_ns()
+        add_phase(profile, 'decode', t2 - t1)
+    else:
+        new_state.pc = pc + 2
+        t1 = t2 = perf_counter_ns()
+    add_phase(profile, 'fetch', t1 - t0)
+
+    (_, handler, instruction) = entry
+    new_state = handler(new_state, instruction)
+    add_phase(profile, 'exec', perf_counter_ns() - t2)
+
+    profile.ops[instruction[0]] += 1
+    profile.pcs[pc] += 1
+    profile.instructions[pc] = instruction
+    return new_state
+
+def profiled_runner(profile):
+    def run_profiled(state, count):
+        new_state = state.copy()
+        try:
+            for _ in range(count):
+                new_state = profiled_fetch_decode_exec(new_state, profile)
+        except WaitingForKey:
+            pass
+        new_state.cycles += count
+        return new_state
+    return run_profiled
+
+def profiled(profile, phase, fn): # fn, timed as one call of `phase`
+    def timed(*args):
+        start = perf_counter_ns()
+        res = fn(*args)
+        add_phase(profile, phase, perf_counter_ns() - start)
+        return res
+    return timed
+
+def profile_report(profile):
+    total = sum(profile.ops)
+    hot = sorted(range(len(profile.pcs)), key=lambda pc: profile.pcs[pc], reverse=True)[:HOT_PCS]
+    return {
+        'instructions': total,
+        'ops': {OP_NAMES[op]: count for op, count in enumerate(profile.ops) if count},
+        'hot_pcs': [{'pc': pc, 'count': profile.pcs[pc],
+                     'instruction': instruction_to_str(profile.instructions[pc])}
+                    for pc in hot if profile.pcs[pc]],
+        'phases': {phase: {'ns': profile.phase_ns[phase], 'calls': profile.phase_calls[phase]}
+                   for phase in PHASES if profile.phase_calls[phase]},
+    }
+
+def percent(part, total):
+    return 100 * part / total if total else 0
+
+def profile_report_to_str(report):
+    total = report['instructions']
+    lines = ["{} instructions".format(total), "", "phase        total ms     calls   ns/call"]
+    for phase, p in report['phases'].items():
+        lines.append("{:10} {:10.1f} {:9} {:9.0f}".format(
+            phase, p['ns'] / 1e6, p['calls'], p['ns'] / p['calls']))
+
+    lines += ["", "op                       count       %"]
+    for name, count in sorted(report['ops'].items(), key=lambda x: x[1], reverse=True):
+        lines.append("{:20} {:9} {:6.1f}%".format(name, count, percent(count, total)))
+
+    lines += ["", "pc       count       %"]
+    for hot in report['hot_pcs']:
+        lines.append("{:03X} {:9} {:6.1f}%  {}".format(
+            hot['pc'], hot['count'], percent(hot['count'], total), hot['instruction']))
+    return '\n'.join(lines)
+
+def dump_profile(profile, fname): # JSON to fname, returns the text report
+    report = profile_report(profile)
+    with open(fname, "w") as f:
+        json.dump(report, f, indent=1)
+    return profile_report_to_str(report)
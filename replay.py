@@ -0,0 +1,82 @@
+# A recording is the state a session started from plus every change of the
+# pressed keys with the instruction count it happened at. Machines are
+# deterministic given their seed, which the state holds, so replaying the
+# key changes with run_script reproduces the session exactly, headless and
+# as fast as the engine runs.
+import zlib
+import struct
+from chip8 import *
+from savestate import save_state, load_state
+
+RECORDING_MAGIC   = b'C8RC'
+RECORDING_VERSION = 1
+
+# magic, version, instructions per frame, last cycle, event count, size of
+# the compressed start state that follows
+RECORDING_HEADER = struct.Struct('<4sBHQII')
+RECORDING_EVENT  = struct.Struct('<IH') # instructions since the previous event, keys
+
+class Recording:
+    __slots__ = ('start', 'ipf', 'events', 'end', 'keys')
+
+    def __init__(self, start, ipf, events, end, keys):
+        self.start  = start # save_state() of the first state
+        self.ipf    = ipf
+        self.events = events # [(cycle, keys)]
+        self.end    = end # cycles when the recording stopped
+        self.keys   = keys # the keys of the last event
+
+def start_recording(state, instructions_per_frame):
+    return Recording(save_state(state), instructions_per_frame, [], state.cycles, state.keys)
+
+def restart_recording(recording, state): # after loading a state, start over from it
+    recording.start  = save_state(state)
+    recording.events = []
+    recording.end    = state.cycles
+    recording.keys   = state.keys
+
+def record_keys(recording, state):
+    if state.keys != recording.keys:
+        recording.events.append((state.cycles, state.keys))
+        recording.keys = state.keys
+    recording.end = state.cycles
+
+def rewind_recording(recording, state): # forget what happened from `state` on
+    while recording.events and recording.events[-1][0] >= state.cycles:
+        recording.events.pop()
+    recording.keys = state.keys
+    recording.end = state.cycles
+
+def write_recording(recording, fname):
+    start = zlib.compress(recording.start)
+    with open(fname, "wb") as f:
+        f.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, recording.ipf,
+                                      recording.end, len(recording.events), len(start)))
+        f.write(start)
+        last = load_state(recording.start).cycles
+        for cycle, keys in recording.events:
+            f.write(RECORDING_EVENT.pack(cycle - last, keys))
+            last = cycle
+
+def read_recording(fname):
+    with open(fname, "rb") as f:
+        data = f.read()
+    (magic, version, ipf, end, count, start_size) = RECORDING_HEADER.unpack_from(data)
+    assert magic == RECORDING_MAGIC and version == RECORDING_VERSION
+    offset = RECORDING_HEADER.size
+    start = zlib.decompress(data[offset : offset + start_size])
+    offset += start_size
+
+    events = []
+    cycle = load_state(start).cycles
+    for i in range(count):
+        (delta, keys) = RECORDING_EVENT.unpack_from(data, offset + i * RECORDING_EVENT.size)
+        cycle += delta
+        events.append((cycle, keys))
+    keys = events[-1][1] if events else load_state(start).keys
+    return Recording(start, ipf, events, end, keys)
+
+def replay(recording, max_cycles=None, run=run_instructions):
+    state = load_state(recording.start)
+    end = max_cycles if max_cycles is not None else recording.end
+    return run_script(state, recording.ipf, recording.events, end, run)
@@ -0,0 +1,135 @@
+# Loads ROMs through a cache of ready-made images, kept on disk under the
+# SHA-1 of the ROM. An image is the whole 4 KB memory the ROM starts in,
+# font included, and every instruction disasm.py finds in it, already
+# decoded. Loading one maps the ROM file, hashes it and reads the image back,
+# instead of copying the ROM into memory and decoding it as it runs.
+#
+# Within a process an image is made once per ROM file and shared: its memory
+# pages are immutable, and the decoded cache a machine starts with refers to
+# those very pages, so its entries stay valid until the ROM writes over them.
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+from chip8 import *
+from disasm import ROM_START, trace_code
+
+IMAGE_MAGIC   = b'C8RI'
+IMAGE_VERSION = 1
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chippy", "roms")
+
+MEMORY_SIZE  = 0x1000
+# magic, version, SHA-1, ROM size, and how many instructions there are of
+# each length, 1 to 4. After the header comes the memory, then the
+# instructions of every length in turn, each one its address followed by it.
+IMAGE_HEADER = struct.Struct('<4sBx20sH4H')
+IMAGE_CODE   = [struct.Struct('<H' + 'H' * length) for length in range(1, 5)]
+
+class RomImage:
+    __slots__ = ('sha1', 'memory', 'code', 'decoded')
+
+    def __init__(self, sha1, memory, code):
+        self.sha1    = sha1
+        self.memory  = memory
+        self.code    = code # [(addr, instruction)], in no particular order
+        self.decoded = {} # quirks -> decoded cache to start with, see predecoded()
+
+IMAGES = {} # (path, size, mtime) -> RomImage, for every ROM this process loaded
+
+def read_rom(path): # the file's bytes, mapped rather than read
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b'' # an empty file cannot be mapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def make_image(rom_data):
+    memory = load_rom_data(default_state(), rom_data).memory
+    (code, _, _) = trace_code(bytes(rom_data))
+    return RomImage(hashlib.sha1(rom_data).digest(), memory,
+                    [(addr, code[addr][1]) for addr in sorted(code)])
+
+def image_to_bytes(image, size):
+    by_length = [[(addr, ) + instruction for addr, instruction in image.code if len(instruction) == length]
+                 for length in range(1, 5)]
+    res = [IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, image.sha1, size, *map(len, by_length)),
+           bytes(image.memory)]
+    for code, entry in zip(by_length, IMAGE_CODE):
+        res += [entry.pack(*values) for values in code]
+    return b''.join(res)
+
+def image_from_bytes(data, sha1): # None if it is not an image of that ROM
+    if len(data) < IMAGE_HEADER.size + MEMORY_SIZE:
+        return None
+    (magic, version, digest, _, *counts) = IMAGE_HEADER.unpack_from(data)
+    if magic != IMAGE_MAGIC or version != IMAGE_VERSION or digest != sha1:
+        return None
+    offset = IMAGE_HEADER.size
+    memory = memory_from_bytes(data[offset : offset + MEMORY_SIZE])
+    offset += MEMORY_SIZE
+    code = []
+    for count, entry in zip(counts, IMAGE_CODE):
+        end = offset + count * entry.size
+        code += [(values[0], values[1:]) for values in entry.iter_unpack(data[offset : end])]
+        offset = end
+    return RomImage(sha1, memory, code)
+
+def image_path(cache_dir, sha1):
+    return os.path.join(cache_dir, sha1.hex() + ".img")
+
+def rom_image(path, cache_dir=CACHE_DIR): # the image of the ROM in `path`, made at most once
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    image = IMAGES.get(key)
+    if image is not None:
+        return image
+
+    rom_data = read_rom(path)
+    sha1 = hashlib.sha1(rom_data).digest()
+    cached = image_path(cache_dir, sha1) if cache_dir is not None else None
+    if cached is not None and os.path.exists(cached):
+        with open(cached, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                image = image_from_bytes(data, sha1)
+    if image is None:
+        image = make_image(rom_data)
+        if cached is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # A file of its own to write to, since the other workers of a farm
+            # may be writing the same image, and never half a file for the next reader
+            (fd, tmp) = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(image_to_bytes(image, len(rom_data)))
+                os.replace(tmp, cached)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+    IMAGES[key] = image
+    return image
+
+# The decoded cache for machines running `image` with `quirks`, in the form
+# fetch_decode_exec keeps it. Instructions that straddle two pages are left
+# out, as fetch_decode_exec leaves them out.
+def predecoded(image, quirks):
+    decoded = image.decoded.get(quirks)
+    if decoded is None:
+        handlers = quirk_handlers(quirks)
+        pages = image.memory.pages
+        decoded = {addr: (pages[addr >> PAGE_BITS], handlers[instruction[0]], instruction)
+                   for addr, instruction in image.code if addr & PAGE_MASK != PAGE_MASK}
+        image.decoded[quirks] = decoded
+    return decoded
+
+# load_rom_data, from an image: the memory below ROM_START stays the state's
+def load_rom_image(state, image):
+    new_state = state
+    keep = ROM_START >> PAGE_BITS
+    new_state.memory = Memory(new_state.memory.pages[:keep] + image.memory.pages[keep:])
+    new_state.decoded = dict(predecoded(image, new_state.quirks))
+    new_state.blocks = {}
+    return new_state
+
+def load_rom_cached(state, path, cache_dir=CACHE_DIR):
+    return load_rom_image(state, rom_image(path, cache_dir))
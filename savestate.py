@@ -0,0 +1,141 @@
+# Save states are one fixed-size struct holding the whole machine, so saving
+# is a single pack and loading a single unpack. The rewind buffer keeps one
+# per frame: every REWIND_KEYFRAME frames a full snapshot, and in between
+# only the XOR with that keyframe, which is mostly zeros and compresses to
+# a few dozen bytes.
+import zlib
+import struct
+from collections import deque
+from chip8 import *
+
+STATE_MAGIC   = b'C8SV'
+STATE_VERSION = 3
+
+# magic, version, pc, index, delay timer, sound timer, keys, stack depth,
+# cycles, rng, quirks, stack (bottom first), regs, display rows, memory
+STATE = struct.Struct('<4sBHIBBHBQIH16H16s32Q4096s')
+
+# The quirks fit in one short: a bit for every flag, and index_increment as
+# its position in INDEX_INCREMENTS from bit 8 on
+QUIRK_FLAGS = tuple(field for field in Quirks._fields if field != 'index_increment')
+
+def quirks_to_bits(quirks):
+    bits = INDEX_INCREMENTS.index(quirks.index_increment) << 8
+    for i, field in enumerate(QUIRK_FLAGS):
+        bits |= getattr(quirks, field) << i
+    return bits
+
+def quirks_from_bits(bits):
+    flags = {field: bool((bits >> i) & 1) for i, field in enumerate(QUIRK_FLAGS)}
+    return Quirks(index_increment=INDEX_INCREMENTS[(bits >> 8) & 3], **flags)
+
+REWIND_KEYFRAME = 60 # frames per keyframe
+
+def save_state(state):
+    stack = stack_to_list(state.stack)
+    return STATE.pack(
+        STATE_MAGIC, STATE_VERSION,
+        state.pc, state.index, state.delay_timer, state.sound_timer, state.keys,
+        len(stack), state.cycles, state.rng, quirks_to_bits(state.quirks),
+        *(stack + [0] * (16 - len(stack))),
+        bytes(state.regs), *state.display, bytes(state.memory))
+
+# Pages equal to the ones in `like` are taken from it, so they stay shared
+# and the decode and block caches of `like` stay valid for them, as long as
+# both run with the same quirks
+def load_state(data, like=None):
+    fields = STATE.unpack_from(data)
+    (magic, version, pc, index, delay_timer, sound_timer, keys, depth, cycles, rng, quirk_bits) = fields[:11]
+    assert magic == STATE_MAGIC and version == STATE_VERSION
+    stack_values = fields[11:11 + depth]
+    regs = fields[27]
+    display = fields[28:60]
+    memory = fields[60]
+    quirks = quirks_from_bits(quirk_bits)
+    if like is not None and like.quirks != quirks:
+        like = None
+
+    pages = []
+    for page in range(len(memory) >> PAGE_BITS):
+        page_data = memory[page << PAGE_BITS : (page + 1) << PAGE_BITS]
+        if like is not None and like.memory.pages[page] == page_data:
+            page_data = like.memory.pages[page]
+        pages.append(page_data)
+
+    stack = empty_stack()
+    for x in stack_values:
+        stack = safe_push(stack, x)
+
+    return Machine(
+        is_running  = True,
+        pc          = pc,
+        index       = index,
+        sound_timer = sound_timer,
+        delay_timer = delay_timer,
+        memory      = Memory(tuple(pages)),
+        display     = display,
+        stack       = stack,
+        regs        = array('B', regs),
+        keys        = keys,
+        decoded     = like.decoded if like is not None else {},
+        dirty       = ALL_ROWS,
+        cycles      = cycles,
+        blocks      = like.blocks if like is not None else {},
+        rng         = rng,
+        idle        = None,
+        quirks      = quirks,
+        handlers    = quirk_handlers(quirks),
+    )
+
+def write_state(state, fname):
+    with open(fname, "wb") as f:
+        f.write(save_state(state))
+
+def read_state(fname, like=None):
+    with open(fname, "rb") as f:
+        return load_state(f.read(), like)
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+# A deque of groups [keyframe, [deltas]], newest last. Old frames are dropped
+# a whole group at a time, since deltas are useless without their keyframe.
+class Rewind:
+    __slots__ = ('groups', 'frames', 'capacity', 'key')
+
+    def __init__(self, capacity):
+        self.groups   = deque()
+        self.frames   = 0
+        self.capacity = capacity # frames
+        self.key      = None # the newest keyframe, uncompressed
+
+def rewind_push(rewind, state):
+    snapshot = save_state(state)
+    groups = rewind.groups
+    if rewind.key is None or len(groups[-1][1]) + 1 >= REWIND_KEYFRAME:
+        groups.append([zlib.compress(snapshot, 1), []])
+        rewind.key = snapshot
+    else:
+        groups[-1][1].append(zlib.compress(xor_bytes(snapshot, rewind.key), 1))
+    rewind.frames += 1
+    while len(groups) > 1 and rewind.frames - (1 + len(groups[0][1])) >= rewind.capacity:
+        rewind.frames -= 1 + len(groups.popleft()[1])
+
+def rewind_pop(rewind, like=None): # the newest frame, None once there are none
+    groups = rewind.groups
+    if not groups:
+        return None
+    (key, deltas) = groups[-1]
+    if rewind.key is None:
+        rewind.key = zlib.decompress(key)
+    if deltas:
+        snapshot = xor_bytes(zlib.decompress(deltas.pop()), rewind.key)
+    else:
+        snapshot = rewind.key
+        groups.pop()
+        rewind.key = None
+    rewind.frames -= 1
+    return load_state(snapshot, like)
+
+def rewind_size(rewind): # bytes held
+    return sum(len(key) + sum(map(len, deltas)) for key, deltas in rewind.groups)
@@ -0,0 +1,77 @@
+# Draws the display in a terminal with half-block characters: one line of
+# text holds two rows of pixels, so the picture is 64x16 cells. The screen
+# remembers the last frame it drew and only rewrites the cells that changed,
+# with a cursor move in front of every run of them, in one write per frame.
+import sys
+from chip8 import *
+
+# Indexed by top pixel << 1 | bottom pixel
+HALF_BLOCKS = (' ', '▄', '▀', '█')
+
+LINES = BASE_HEIGHT // 2
+
+# Unchanged cells between two runs that are cheaper to rewrite than to skip
+# with another cursor move
+RUN_GAP = 4
+
+HIDE_CURSOR = '\x1b[?25l'
+SHOW_CURSOR = '\x1b[?25h'
+CLEAR       = '\x1b[2J'
+
+def move_to(line, column): # 0-based, the terminal counts from 1
+    return '\x1b[{};{}H'.format(line + 1, column + 1)
+
+class TerminalScreen:
+    __slots__ = ('out', 'last')
+
+    def __init__(self, out=sys.stdout):
+        self.out  = out
+        self.last = None # display drawn last, None before the first frame
+
+def reverse_bits(row): # so that bit N is column N, as dirty_runs expects
+    return int(format(row, '064b')[::-1], 2)
+
+def changed_runs(changed):
+    runs = []
+    for start, end in dirty_runs(reverse_bits(changed)):
+        if runs and start - runs[-1][1] <= RUN_GAP:
+            runs[-1] = (runs[-1][0], end)
+        else:
+            runs.append((start, end))
+    return runs
+
+def cells(top, bottom, start, end):
+    return ''.join([HALF_BLOCKS[pixel(top, x) << 1 | pixel(bottom, x)] for x in range(start, end)])
+
+def terminal_frame(last, display): # the text that turns `last` into `display`
+    res = []
+    for line in range(LINES):
+        top    = display[2 * line]
+        bottom = display[2 * line + 1]
+        if last is None:
+            changed = (1 << BASE_WIDTH) - 1
+        else:
+            changed = (top ^ last[2 * line]) | (bottom ^ last[2 * line + 1])
+        if changed == 0:
+            continue
+        for start, end in changed_runs(changed):
+            res.append(move_to(line, start))
+            res.append(cells(top, bottom, start, end))
+    return ''.join(res)
+
+def open_terminal(screen):
+    screen.out.write(HIDE_CURSOR + CLEAR)
+    screen.last = None
+
+def draw_terminal_impure(state, screen):
+    if screen.last is state.display:
+        return
+    text = terminal_frame(screen.last, state.display)
+    if text:
+        screen.out.write(text)
+        screen.out.flush()
+    screen.last = state.display
+
+def close_terminal(screen):
+    screen.out.write(move_to(LINES, 0) + SHOW_CURSOR)
+    screen.out.flush()
@@ -0,0 +1,34 @@
+# Regression tests for idle.py: skipping idle loops has to give exactly the
+# state running every instruction gives. Run with python3 -m unittest.
+import unittest
+from chip8 import *
+from blocks import run_blocks
+from idle import idle_runner
+
+# Reads the delay timer into V1 and sets it back to V0 = 7 every time around
+# the loop at 0x22A, so the loop is idle only once V1 holds the timer
+TIMER_WRITE_ROM = bytes.fromhex('610060076207f215' + '0000' * 17 + 'f107f015122a')
+
+# Waits 255 frames for the delay timer, then counts in V1
+TIMER_WAIT_ROM = bytes.fromhex('60fff015f007300012047101120c')
+
+class IdleTest(unittest.TestCase):
+    def assert_same_as_without_idle(self, rom, frames):
+        for engine in (run_instructions, run_blocks):
+            state = load_rom_data(default_state(), rom)
+            plain = run_for(state.copy(), INSTRUCTIONS_PER_FRAME, max_frames=frames, run=engine)
+            idle = run_for(state.copy(), INSTRUCTIONS_PER_FRAME, max_frames=frames,
+                           run=idle_runner(engine))
+            self.assertEqual(state_hash(idle), state_hash(plain))
+            self.assertEqual(idle.cycles, plain.cycles)
+
+    def test_loop_writing_the_timer(self):
+        for frames in (3, 10, 1000):
+            self.assert_same_as_without_idle(TIMER_WRITE_ROM, frames)
+
+    def test_wait_for_the_timer(self):
+        for frames in (3, 254, 255, 256, 300):
+            self.assert_same_as_without_idle(TIMER_WAIT_ROM, frames)
+
+if __name__ == "__main__":
+    unittest.main()